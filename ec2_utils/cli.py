@@ -4,10 +4,12 @@ import argparse
 import inspect
 import json
 import locale
+import re
 import sys
 import time
 import netifaces
 from datetime import datetime, timedelta
+from functools import partial
 from dateutil.tz import tzutc
 from jmespath import search
 from argcomplete.completers import ChoicesCompleter, FilesCompleter
@@ -550,9 +552,16 @@ def log_to_cloudwatch():
     The log group will be the stack name that created instance if not given
     as an argument. The logstream will be the instance id and filename if not
     given as an argument. Group and stream aare created if they do not exist.
+    Several files or glob patterns can be given to ship each matching file to
+    its own stream from a single process.
     """
     parser = _get_parser()
-    parser.add_argument("file", help="File to follow").completer = FilesCompleter()
+    parser.add_argument(
+        "file",
+        help="File or quoted glob pattern to follow, "
+        + "a named pipe or '-' for stdin",
+        nargs="+",
+    ).completer = FilesCompleter()
     parser.add_argument(
         "-g",
         "--group",
@@ -567,11 +576,338 @@ def log_to_cloudwatch():
         "--stream",
         help="The log stream name to log"
         + " to. The instance id and "
-        + "filename if not given",
+        + "filename if not given. Only "
+        + "valid with a single file",
+    )
+    parser.add_argument(
+        "--checkpoint-dir",
+        help="Directory to save the position of "
+        + "sent lines in so that shipping resumes "
+        + "from there after a restart. Defaults to "
+        + logs.CHECKPOINT_DIR,
+        default=logs.CHECKPOINT_DIR,
+    ).completer = FilesCompleter()
+    parser.add_argument(
+        "--no-checkpoint",
+        help="Do not save or resume from a checkpoint",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--max-queue-bytes",
+        help="Bytes of log lines to hold in memory "
+        + "before spooling to disk, at least "
+        + str(logs.SPOOL_SEGMENT_BYTES)
+        + ". Defaults to "
+        + str(logs.MAX_QUEUE_BYTES),
+        type=int,
+        default=logs.MAX_QUEUE_BYTES,
+    )
+    parser.add_argument(
+        "--spool-dir",
+        help="Directory to spool lines to when "
+        + "CloudWatch can not keep up. Defaults to "
+        + logs.SPOOL_DIR,
+        default=logs.SPOOL_DIR,
+    ).completer = FilesCompleter()
+    parser.add_argument(
+        "--no-spool",
+        help="Keep queued lines only in memory",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--spool-bytes",
+        help="Maximum bytes to spool to disk per "
+        + "stream. Defaults to "
+        + str(logs.SPOOL_BYTES),
+        type=int,
+        default=logs.SPOOL_BYTES,
+    )
+    parser.add_argument(
+        "--overflow",
+        help="What to do when the queue is full: "
+        + "drop the oldest or newest lines or "
+        + "block reading. Defaults to "
+        + logs.OVERFLOW_DROP_OLDEST,
+        choices=logs.OVERFLOW_POLICIES,
+        default=logs.OVERFLOW_DROP_OLDEST,
+    )
+    parser.add_argument(
+        "--timestamp-format",
+        help="Take event times from the start of "
+        + "lines in this format instead of the "
+        + "time the line was read",
+        choices=logs.TIMESTAMP_FORMATS,
+    )
+    parser.add_argument(
+        "--multiline-start",
+        help="Regular expression matching the first "
+        + "line of a multi-line event such as a "
+        + "stack trace. Other lines are appended "
+        + "to the previous event",
+    )
+    parser.add_argument(
+        "--multiline-continue",
+        help="Regular expression matching lines "
+        + "that continue the previous event",
+    )
+    parser.add_argument(
+        "--multiline-max-lines",
+        help="Maximum lines in a multi-line event. "
+        + "Defaults to "
+        + str(logs.MULTILINE_MAX_LINES),
+        type=int,
+        default=logs.MULTILINE_MAX_LINES,
+    )
+    parser.add_argument(
+        "--multiline-max-bytes",
+        help="Maximum bytes in a multi-line event. "
+        + "Defaults to "
+        + str(logs.MULTILINE_MAX_BYTES),
+        type=int,
+        default=logs.MULTILINE_MAX_BYTES,
+    )
+    parser.add_argument(
+        "--multiline-timeout",
+        help="Seconds to wait for more lines before "
+        + "sending a multi-line event. Defaults to "
+        + str(logs.MULTILINE_TIMEOUT),
+        type=float,
+        default=logs.MULTILINE_TIMEOUT,
+    )
+    parser.add_argument(
+        "--include",
+        help="Only ship lines matching this regular "
+        + "expression. Can be given multiple times",
+        action="append",
+    )
+    parser.add_argument(
+        "--exclude",
+        help="Do not ship lines matching this regular "
+        + "expression. Can be given multiple times",
+        action="append",
+    )
+    parser.add_argument(
+        "--sample",
+        help="RATE:REGEX - ship only the fraction RATE "
+        + "of lines matching REGEX, e.g. 0.01:health. "
+        + "Can be given multiple times",
+        action="append",
+    )
+    parser.add_argument(
+        "--redact",
+        help="Replace matches of this regular "
+        + "expression with "
+        + logs.REDACTED
+        + ". Can be given multiple times",
+        action="append",
+    )
+    parser.add_argument(
+        "--metric-field",
+        help="Numeric field of JSON lines to aggregate "
+        + "into metrics. Nested fields are given as "
+        + "dotted paths. Can be given multiple times",
+        action="append",
+    )
+    parser.add_argument(
+        "--metric-dimension",
+        help="Field of JSON lines to use as a metric "
+        + "dimension. Can be given multiple times",
+        action="append",
+    )
+    parser.add_argument(
+        "--metric-namespace",
+        help="CloudWatch namespace of metrics. "
+        + "Defaults to "
+        + logs.METRIC_NAMESPACE,
+        default=logs.METRIC_NAMESPACE,
+    )
+    parser.add_argument(
+        "--metric-interval",
+        help="Seconds to aggregate metrics over. "
+        + "Defaults to "
+        + str(logs.METRIC_INTERVAL),
+        type=int,
+        default=logs.METRIC_INTERVAL,
+    )
+    parser.add_argument(
+        "--metric-percentiles",
+        help="Comma separated percentiles to calculate. "
+        + "Defaults to "
+        + ",".join(str(percent) for percent in logs.METRIC_PERCENTILES),
+        default=",".join(str(percent) for percent in logs.METRIC_PERCENTILES),
+    )
+    parser.add_argument(
+        "--metric-output",
+        help="Send metrics as embedded metric format "
+        + "log events or with put-metric-data. "
+        + "Defaults to "
+        + logs.METRIC_OUTPUT_EMF,
+        choices=logs.METRIC_OUTPUTS,
+        default=logs.METRIC_OUTPUT_EMF,
+    )
+    parser.add_argument(
+        "--metric-keep-lines",
+        help="Also ship the lines metrics were taken from",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--max-latency",
+        help="Seconds a line may wait before a partial "
+        + "batch is sent. Defaults to "
+        + str(logs.MAX_LATENCY),
+        type=float,
+        default=logs.MAX_LATENCY,
+    )
+    parser.add_argument(
+        "--flush-interval",
+        help="Maximum seconds between checks for "
+        + "something to send when otherwise idle. "
+        + "Defaults to "
+        + str(logs.FLUSH_INTERVAL),
+        type=float,
+        default=logs.FLUSH_INTERVAL,
+    )
+    parser.add_argument(
+        "--batch-bytes",
+        help="Bytes in a batch that is sent right away. "
+        + "Defaults to the CloudWatch maximum of "
+        + str(logs.MAX_BATCH_BYTES),
+        type=int,
+        default=logs.MAX_BATCH_BYTES,
+    )
+    parser.add_argument(
+        "--batch-events",
+        help="Events in a batch that is sent right "
+        + "away. Defaults to the CloudWatch maximum of "
+        + str(logs.MAX_BATCH_EVENTS),
+        type=int,
+        default=logs.MAX_BATCH_EVENTS,
+    )
+    parser.add_argument(
+        "--compression",
+        help="Compression of request bodies sent to "
+        + "CloudWatch. gzip falls back to none if the "
+        + "endpoint rejects compressed requests. Defaults to "
+        + logs.COMPRESSION_NONE,
+        choices=logs.COMPRESSION_TYPES,
+        default=logs.COMPRESSION_NONE,
+    )
+    parser.add_argument(
+        "--datagram",
+        help="Bind unix datagram sockets at the given "
+        + "paths and ship each datagram received as "
+        + "an event, e.g. for syslog",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--shards",
+        help="Spread each file over this many log "
+        + "streams named <stream>|0..N-1 to get past "
+        + "the put rate limit of one stream",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--stats-port",
+        help="Serve the shipper's own metrics in the "
+        + "Prometheus text format over HTTP on this "
+        + "port on localhost",
+        type=int,
+    )
+    parser.add_argument(
+        "--stats-socket",
+        help="Serve the shipper's own metrics in the "
+        + "Prometheus text format over HTTP on a unix "
+        + "socket at this path",
     )
     argcomplete.autocomplete(parser)
     args = parser.parse_args()
-    logs.send_log_to_cloudwatch(args.file, group=args.group, stream=args.stream)
+    if args.stream and (len(args.file) > 1 or logs.GLOB_MAGIC.search(args.file[0])):
+        parser.error("--stream can only be given with a single file")
+    if args.max_queue_bytes < logs.SPOOL_SEGMENT_BYTES:
+        parser.error(
+            "--max-queue-bytes must be at least " + str(logs.SPOOL_SEGMENT_BYTES)
+        )
+    stages = []
+    if args.multiline_start or args.multiline_continue:
+        stages.append(
+            partial(
+                logs.MultilineAssembler,
+                start_pattern=args.multiline_start,
+                continuation_pattern=args.multiline_continue,
+                max_lines=args.multiline_max_lines,
+                max_bytes=args.multiline_max_bytes,
+                flush_timeout=args.multiline_timeout,
+            )
+        )
+    if args.include or args.exclude or args.sample or args.redact:
+        samples = []
+        for sample in args.sample or []:
+            rate, _, pattern = sample.partition(":")
+            try:
+                samples.append((float(rate), pattern))
+            except ValueError:
+                parser.error("--sample must be given as RATE:REGEX")
+        for pattern in (
+            (args.include or [])
+            + (args.exclude or [])
+            + [pattern for _, pattern in samples]
+            + (args.redact or [])
+        ):
+            try:
+                re.compile(pattern)
+            except re.error as err:
+                parser.error("Invalid regular expression " + pattern + ": " + str(err))
+        # Filter whole events after multi-line assembly
+        stages.append(
+            partial(
+                logs.LineFilter,
+                includes=args.include,
+                excludes=args.exclude,
+                samples=samples,
+                redact=args.redact,
+            )
+        )
+    if args.metric_field:
+        try:
+            percentiles = [
+                float(percent) for percent in args.metric_percentiles.split(",")
+            ]
+        except ValueError:
+            parser.error("--metric-percentiles must be comma separated numbers")
+        stages.append(
+            partial(
+                logs.MetricExtractor,
+                fields=args.metric_field,
+                dimensions=args.metric_dimension,
+                namespace=args.metric_namespace,
+                interval=args.metric_interval,
+                percentiles=percentiles,
+                output=args.metric_output,
+                keep_lines=args.metric_keep_lines,
+            )
+        )
+    logs.send_logs_to_cloudwatch(
+        args.file,
+        group=args.group,
+        stream=args.stream,
+        checkpoint_dir=None if args.no_checkpoint else args.checkpoint_dir,
+        stages=stages,
+        flush_interval=args.flush_interval,
+        max_latency=args.max_latency,
+        compression=args.compression,
+        stats_port=args.stats_port,
+        stats_socket=args.stats_socket,
+        datagram=args.datagram,
+        shards=max(1, args.shards),
+        max_queue_bytes=args.max_queue_bytes,
+        spool_dir=None if args.no_spool else args.spool_dir,
+        spool_bytes=args.spool_bytes,
+        overflow=args.overflow,
+        timestamp_format=args.timestamp_format,
+        batch_bytes=min(args.batch_bytes, logs.MAX_BATCH_BYTES),
+        batch_events=min(args.batch_events, logs.MAX_BATCH_EVENTS),
+    )
 
 
 def get_logs():
@@ -602,6 +938,75 @@ def get_logs():
         help="Print timestamps and log groups in shorter format",
         action="store_true",
     )
+    parser.add_argument(
+        "--rate",
+        help="Requests per second to start fetching "
+        + "at. Defaults to "
+        + str(logs.FETCH_RATE),
+        type=float,
+        default=logs.FETCH_RATE,
+    )
+    parser.add_argument(
+        "--max-rate",
+        help="Requests per second the rate may grow "
+        + "to until throttled. Defaults to "
+        + str(logs.FETCH_MAX_RATE),
+        type=float,
+        default=logs.FETCH_MAX_RATE,
+    )
+    parser.add_argument(
+        "--burst",
+        help="Requests that may be sent at once. "
+        + "Defaults to "
+        + str(logs.FETCH_BURST),
+        type=int,
+        default=logs.FETCH_BURST,
+    )
+    parser.add_argument(
+        "--output",
+        help="Output format. text is for reading and "
+        + "colored on a terminal, jsonl and tsv have a line per event "
+        + "and raw only the messages. Defaults to "
+        + logs.OUTPUT_TEXT,
+        choices=logs.OUTPUT_FORMATS,
+        default=logs.OUTPUT_TEXT,
+    )
+    parser.add_argument(
+        "--insights",
+        metavar="QUERY",
+        help="Run a CloudWatch Logs Insights query over the matching "
+        + "groups and print the result rows instead of the events. Groups "
+        + "are queried in batches of "
+        + str(logs.INSIGHTS_MAX_GROUPS)
+        + ", so aggregates are per batch. The end time defaults to now",
+    )
+    parser.add_argument(
+        "--export",
+        metavar="DIR",
+        help="Export events to a gzipped file per group in DIR "
+        + "instead of printing them. Each group is fetched in time "
+        + "shards in parallel and an interrupted export resumes from "
+        + "the shards recorded in DIR/"
+        + logs.EXPORT_MANIFEST
+        + ". Files are in the --output format, jsonl for text. The end "
+        + "time defaults to now",
+    )
+    parser.add_argument(
+        "--export-shards",
+        help="Time shards to split each group into when exporting. "
+        + "Defaults to "
+        + str(logs.EXPORT_SHARDS),
+        type=int,
+        default=logs.EXPORT_SHARDS,
+    )
+    parser.add_argument(
+        "--no-cache",
+        help="List log groups from CloudWatch instead of "
+        + "using names cached for up to "
+        + str(logs.LOG_GROUP_CACHE_TTL)
+        + " seconds",
+        action="store_true",
+    )
     parser.usage = "ndt logs log_group_pattern [-h] [-f FILTER] [-s START [START ...]] [-e END [END ...]] [-o]"
     argcomplete.autocomplete(parser)
     args = parser.parse_args()
@@ -612,6 +1017,14 @@ def get_logs():
         end_time=" ".join(args.end) if args.end else None,
         sort=args.order,
         short_format=args.shortformat,
+        rate=args.rate,
+        burst=args.burst,
+        max_rate=args.max_rate,
+        group_cache=None if args.no_cache else logs.LogGroupCache(),
+        output=args.output,
+        export_dir=args.export,
+        export_shards=args.export_shards,
+        insights=args.insights,
     )
     cwlogs_groups.get_logs()
 
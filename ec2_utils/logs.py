@@ -49,26 +49,196 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import asyncio
+import bisect
+import calendar
+import ctypes
+import glob
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
 import os
+import random
+import select
+import shutil
+import socket
+import stat
+import struct
 import sys
 import time
 import re
-import queue
 from builtins import object, range
 from past.utils import old_div
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from ctypes.util import find_library
+from functools import partial
+from operator import itemgetter
 from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from os.path import expanduser
 from dateutil import tz
 from dateutil.parser import parse
 from dateutil.tz import tzutc
 from termcolor import colored
-from threading import Event, Lock, Thread, BoundedSemaphore
+from threading import Event, Condition, Lock, Thread, current_thread
+from boto3.session import Session
 from botocore.compat import total_seconds
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from threading import Event, Lock, Thread
 from ec2_utils.instance_info import info
 from ec2_utils.words import hashed_word
 from retry import retry
-from threadlocal_aws.clients import logs
+from threadlocal_aws import region
+from threadlocal_aws.clients import cloudwatch, logs
+
+CHECKPOINT_DIR = os.path.join(expanduser("~"), ".ndt", "log-checkpoints")
+CHECKPOINT_INTERVAL = 1.0
+SEND_WORKERS = 4
+GLOB_MAGIC = re.compile(r"[*?[]")
+STDIN = "-"
+MAX_QUEUE_BYTES = 32 * 1024 * 1024
+SPOOL_DIR = os.path.join(expanduser("~"), ".ndt", "log-spool")
+SPOOL_BYTES = 256 * 1024 * 1024
+SPOOL_SEGMENT_BYTES = 1024 * 1024
+OVERFLOW_DROP_OLDEST = "drop-oldest"
+OVERFLOW_DROP_NEWEST = "drop-newest"
+OVERFLOW_BLOCK = "block"
+OVERFLOW_POLICIES = [OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_BLOCK]
+SPOOL_RECORD = struct.Struct(">QI")
+MAX_EVENT_AGE = 14 * 24 * 3600 * 1000
+MAX_EVENT_AHEAD = 2 * 3600 * 1000
+MAX_BATCH_SPAN = 24 * 3600 * 1000
+MAX_BATCH_BYTES = 1048576
+MAX_BATCH_EVENTS = 10000
+EVENT_OVERHEAD = 26
+MAX_EVENT_BYTES = 256 * 1024 - EVENT_OVERHEAD
+FLUSH_INTERVAL = 10.0
+FLUSH_TIMEOUT = 30.0
+MAX_LATENCY = 2.0
+RETRY_DELAY = 5.0
+MAX_BATCHES_IN_FLIGHT = 2
+BATCH_PENDING = 0
+BATCH_IN_FLIGHT = 1
+BATCH_DONE = 2
+UNRETRYABLE_PUT_ERRORS = ["InvalidParameterException", "DataAlreadyAcceptedException"]
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_NONE = "none"
+COMPRESSION_TYPES = [COMPRESSION_GZIP, COMPRESSION_NONE]
+COMPRESSION_MIN_BYTES = 1024
+COMPRESSION_LEVEL = 6
+# Errors an endpoint that does not take compressed bodies may answer with
+COMPRESSION_REJECTED_ERRORS = [
+    "SerializationException",
+    "UnsupportedMediaTypeException",
+]
+REDACTED = "[REDACTED]"
+# Inline flags and backreferences change meaning inside an alternation
+UNCOMBINABLE_PATTERN = re.compile(r"\(\?[aiLmsux]+\)|\\[1-9]|\(\?P=")
+STATS_PREFIX = "ec2_utils_log_"
+BATCH_EVENT_BUCKETS = [1, 10, 100, 1000, 5000, 10000]
+BATCH_BYTE_BUCKETS = [1024, 16384, 131072, 524288, 1048576]
+PUT_LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+FETCH_CONCURRENCY = 64
+# FilterLogEvents allows 5 requests per second per account and region by
+# default, the limiter probes upwards from there to the raised quota if any
+FETCH_RATE = 4.5
+FETCH_MIN_RATE = 0.5
+FETCH_MAX_RATE = 50.0
+FETCH_BURST = 5
+FETCH_RATE_STEP = 0.5
+FETCH_BACKOFF = 0.5
+FETCH_TRIES = 5
+# Insights reports too many concurrent queries as LimitExceededException
+THROTTLING_ERRORS = [
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "LimitExceededException",
+]
+FETCH_RETRY_DELAY = 2.0
+FETCH_SLICES = 8
+FETCH_MIN_SLICE = 60 * 1000
+LOG_GROUP_CACHE_DIR = os.path.join(expanduser("~"), ".ndt", "log-group-cache")
+LOG_GROUP_CACHE_TTL = 300
+LOG_GROUP_PAGE = 50
+REGEX_SPECIAL = set(".^$*+?{}[]\\|()")
+MERGE_INTERVAL = 0.1
+OUTPUT_TEXT = "text"
+OUTPUT_JSONL = "jsonl"
+OUTPUT_TSV = "tsv"
+OUTPUT_RAW = "raw"
+OUTPUT_FORMATS = [OUTPUT_TEXT, OUTPUT_JSONL, OUTPUT_TSV, OUTPUT_RAW]
+INSIGHTS_MAX_GROUPS = 50
+INSIGHTS_CONCURRENCY = 10
+INSIGHTS_POLL = 0.5
+INSIGHTS_MAX_POLL = 5.0
+INSIGHTS_DONE = ["Complete", "Failed", "Cancelled", "Timeout", "Unknown"]
+EXPORT_SHARDS = 16
+EXPORT_MANIFEST = "manifest.json"
+EXPORT_SUFFIXES = {
+    OUTPUT_JSONL: ".jsonl.gz",
+    OUTPUT_TSV: ".tsv.gz",
+    OUTPUT_RAW: ".log.gz",
+}
+TSV_ESCAPES = {ord("\\"): "\\\\", ord("\t"): "\\t", ord("\n"): "\\n", ord("\r"): "\\r"}
+MERGE_LAG = 2000
+MERGE_MAX_EVENTS = 100000
+METRIC_INTERVAL = 60
+METRIC_NAMESPACE = "LogMetrics"
+METRIC_PERCENTILES = [50, 90, 99]
+METRIC_SAMPLES = 10000
+METRIC_DATUMS = 1000
+METRIC_OUTPUT_EMF = "emf"
+METRIC_OUTPUT_PUT = "put-metric-data"
+METRIC_OUTPUTS = [METRIC_OUTPUT_EMF, METRIC_OUTPUT_PUT]
+MULTILINE_MAX_LINES = 500
+MULTILINE_MAX_BYTES = MAX_EVENT_BYTES
+MULTILINE_TIMEOUT = 1.0
+TIMESTAMP_ISO8601 = "iso8601"
+TIMESTAMP_SYSLOG = "syslog"
+TIMESTAMP_CLF = "clf"
+TIMESTAMP_FORMATS = [TIMESTAMP_ISO8601, TIMESTAMP_SYSLOG, TIMESTAMP_CLF]
+ISO8601_PREFIX = re.compile(
+    r"\s*(\d{4}-\d{2}-\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:[.,](\d+))?"
+    r"\s?(Z|[+-]\d{2}:?\d{2})?"
+)
+SYSLOG_PREFIX = re.compile(r"\s*([A-Z][a-z]{2}) +(\d{1,2}) (\d{2}):(\d{2}):(\d{2})")
+CLF_PREFIX = re.compile(
+    r"[^\[]*\[(\d{2})/([A-Z][a-z]{2})/(\d{4}):(\d{2}):(\d{2}):(\d{2}) ([+-]\d{4})\]"
+)
+TIMESTAMP_VARIANT = re.compile(
+    r"(\d{4}-\d{2}-\d{2})(?:([T ])(\d{2}:\d{2}:\d{2})([.,]\d{3})?)?"
+    r"|(\d{2}:\d{2}:\d{2})([.,]\d{3})?"
+)
+REDUNDANT_WINDOW = 5
+OFFSET_PERIOD = 15 * 60 * 1000
+REDUNDANT_CACHE_SIZE = 4096
+MONTHS = dict(
+    (month, index + 1)
+    for index, month in enumerate(
+        "Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec".split()
+    )
+)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+FOLLOW_EVENTS = (
+    IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+)
+READ_CHUNK = 65536
+HEAD_FINGERPRINT_BYTES = 1024
+MAX_LINE = 262144
+COMPRESSED_SUFFIXES = (".gz", ".bz2", ".xz", ".zst", ".zip", ".lz4")
+AGO_REGEXP = (
+    r"(\d+)\s?(m|minute|minutes|h|hour|hours|d|day|days|w|weeks|weeks)(?: ago)?"
+)
 
 
 def millis2utcdatetime(millis):
@@ -79,29 +249,76 @@ def millis2localdatetime(millis):
     return millis2utcdatetime(millis).astimezone(tz.tzlocal())
 
 
+class TimeFormatter(object):
+    """Formats epoch milliseconds like fmttime or utcfmttime without
+    building datetimes for each call. The local UTC offset is looked up once
+    per OFFSET_PERIOD, dates once per day and times once per second"""
+
+    def __init__(self, utc=False):
+        self.utc = utc
+        self.separator = "T" if utc else " "
+        self._offsets = {}
+        self._day = (None, None)
+        self._second = (None, None)
+
+    def offset(self, millis):
+        """Local UTC offset in seconds at millis"""
+        if self.utc:
+            return 0
+        period = millis // OFFSET_PERIOD
+        offset = self._offsets.get(period)
+        if offset is None:
+            local = millis2localdatetime(period * OFFSET_PERIOD)
+            offset = int(total_seconds(local.utcoffset()))
+            self._offsets[period] = offset
+        return offset
+
+    def day(self, millis):
+        """Days since epoch in local time"""
+        return (millis // 1000 + self.offset(millis)) // 86400
+
+    def seconds(self, millis):
+        """Formatted date and time to seconds precision"""
+        second = millis // 1000
+        cached_second, text = self._second
+        if cached_second == second:
+            return text
+        local = second + self.offset(millis)
+        day, time_of_day = divmod(local, 86400)
+        cached_day, date = self._day
+        if cached_day != day:
+            date = time.strftime("%Y-%m-%d", time.gmtime(day * 86400))
+            self._day = (day, date)
+        hours, rest = divmod(time_of_day, 3600)
+        minutes, seconds = divmod(rest, 60)
+        text = "%s%s%02d:%02d:%02d" % (date, self.separator, hours, minutes, seconds)
+        self._second = (second, text)
+        return text
+
+    def iso(self, millis):
+        return "%s.%03d" % (self.seconds(millis), millis % 1000)
+
+    def short(self, millis):
+        return "%s.%03d" % (self.seconds(millis)[11:], millis % 1000)
+
+
+_local_time = TimeFormatter()
+_utc_time = TimeFormatter(utc=True)
+
+
 def millis2iso(millis):
-    return fmttime(millis2utcdatetime(millis))
+    return _local_time.iso(millis)
 
 
 def millis2utciso(millis):
-    return utcfmttime(millis2utcdatetime(millis))
+    return _utc_time.iso(millis)
 
 
 def short_timeformat(start, timestamp):
-    start_dt = millis2localdatetime(start)
-    tstamp_dt = millis2localdatetime(timestamp)
     day = "0 "
-    tzdiff_start = tz.tzlocal().utcoffset(millis2utcdatetime(start)).seconds / 3600
-    start_delta = timedelta(hours=tzdiff_start)
-    tzdiff_timestamp = (
-        tz.tzlocal().utcoffset(millis2utcdatetime(timestamp)).seconds / 3600
-    )
-    timestamp_delta = timedelta(hours=tzdiff_timestamp)
     if start:
-        start_day = start_dt - datetime(1970, 1, 1, tzinfo=tzutc()) + start_delta
-        tstamp_day = tstamp_dt - datetime(1970, 1, 1, tzinfo=tzutc()) + timestamp_delta
-        day = "{:01d} ".format(tstamp_day.days - start_day.days)
-    return day + short_fmttime(millis2utcdatetime(timestamp))
+        day = "{:01d} ".format(_local_time.day(timestamp) - _local_time.day(start))
+    return day + _local_time.short(timestamp)
 
 
 def timestamp(tstamp):
@@ -128,6 +345,9 @@ def uprint(message):
 
 
 def redundant_timeformats(timestamp):
+    """Forms of the time of an event a message may repeat. Replaced by
+    TimestampStripper and kept as the reference it is checked and
+    benchmarked against in tests/timestamp-strip.sh"""
     all_fmts = set()
     for offset in range(0, 10):
         all_fmts.update(append_formats(millis2iso(timestamp + offset - 5)))
@@ -160,6 +380,73 @@ def append_formats(timestr):
     return ret
 
 
+class TimestampStripper(object):
+    """Removes the forms redundant_timeformats lists for a timestamp from a
+    message in a single pass"""
+
+    def __init__(self, window=REDUNDANT_WINDOW):
+        self.window = window
+        self._windows = {}
+
+    def _formats(self, first, last):
+        """Strings to seconds precision, times of day and dates for the
+        seconds from first to last, in local time and UTC"""
+        key = (first, last)
+        formats = self._windows.get(key)
+        if formats is None:
+            if len(self._windows) >= REDUNDANT_CACHE_SIZE:
+                self._windows.clear()
+            seconds, times, dates = {}, {}, set()
+            for second in range(first, last + 1):
+                local = millis2iso(second * 1000)[:19]
+                utc = millis2utciso(second * 1000)[:19]
+                for timestr in (local, utc, utc.replace("T", " ")):
+                    seconds[timestr] = second
+                    times[timestr[11:]] = second
+                    dates.add(timestr[:10])
+            formats = (seconds, times, dates)
+            self._windows[key] = formats
+        return formats
+
+    def strip(self, message, timestamp):
+        low = timestamp - self.window
+        high = timestamp + self.window - 1
+        seconds, times, dates = self._formats(low // 1000, high // 1000)
+
+        def in_window(second, fraction):
+            return low <= second * 1000 + int(fraction[1:]) <= high
+
+        def strip_time(time_of_day, fraction):
+            second = times.get(time_of_day)
+            if second is None:
+                return time_of_day + (fraction or "")
+            if fraction and not in_window(second, fraction):
+                return fraction
+            return ""
+
+        def replace(match):
+            date, separator, time_of_day, fraction, time_only, time_fraction = (
+                match.groups()
+            )
+            if time_only:
+                return strip_time(time_only, time_fraction)
+            if not time_of_day:
+                return "" if date in dates else date
+            second = seconds.get(date + separator + time_of_day)
+            if second is not None:
+                if fraction and not in_window(second, fraction):
+                    return fraction
+                return ""
+            # Date and time of day may still match on their own
+            return (
+                ("" if date in dates else date)
+                + separator
+                + strip_time(time_of_day, fraction)
+            )
+
+        return TIMESTAMP_VARIANT.sub(replace, message)
+
+
 def validatestarttime(start_time):
     return int(start_time) * 1000 if start_time else int((time.time() - 60) * 1000)
 
@@ -170,10 +457,7 @@ def parse_datetime(datetime_text):
     if not datetime_text:
         return None
 
-    ago_regexp = (
-        r"(\d+)\s?(m|minute|minutes|h|hour|hours|d|day|days|w|weeks|weeks)(?: ago)?"
-    )
-    ago_match = re.match(ago_regexp, datetime_text)
+    ago_match = re.match(AGO_REGEXP, datetime_text)
 
     if ago_match:
         amount, unit = ago_match.groups()
@@ -199,126 +483,1917 @@ def parse_datetime(datetime_text):
     return int(total_seconds(date - datetime(1970, 1, 1)))
 
 
-class IntervalThread(Thread):
-    def __init__(self, event, interval, call_function):
-        Thread.__init__(self)
-        self._stopped = event
-        self._interval = interval
-        self._call_function = call_function
+def relative_datetime(datetime_text):
+    """Whether ``datetime_text`` is missing or relative to the current time"""
+    return (
+        not datetime_text
+        or datetime_text == "now"
+        or bool(re.match(AGO_REGEXP, datetime_text))
+    )
 
-    def run(self):
-        while not self._stopped.wait(self._interval):
-            self._call_function()
+
+class TimestampParser(object):
+    """Parses the time of an event from the start of a log line. Supported
+    formats are ISO-8601 (iso8601), syslog (syslog) and the common log
+    format of web servers (clf). Times without a zone are local time. Day
+    starts and local time zone offsets are cached, so parsing a line is
+    mostly a regular expression match and some integer arithmetic"""
+
+    def __init__(self, timestamp_format):
+        self.timestamp_format = timestamp_format
+        self._regex, self._parse = {
+            TIMESTAMP_ISO8601: (ISO8601_PREFIX, self._parse_iso8601),
+            TIMESTAMP_SYSLOG: (SYSLOG_PREFIX, self._parse_syslog),
+            TIMESTAMP_CLF: (CLF_PREFIX, self._parse_clf),
+        }[timestamp_format]
+        self._days = {}
+        self._offsets = {}
+
+    def parse(self, line):
+        """Returns the timestamp in milliseconds or None if the line does not
+        start with a timestamp"""
+        match = self._regex.match(line)
+        if not match:
+            return None
+        try:
+            return self._parse(match)
+        except (ValueError, KeyError, OverflowError):
+            return None
+
+    def _parse_iso8601(self, match):
+        date, hour, minute, second, fraction, zone = match.groups()
+        seconds = self._day(date, int(date[:4]), int(date[5:7]), int(date[8:10]))
+        seconds += int(hour) * 3600 + int(minute) * 60 + int(second)
+        if zone is None:
+            seconds -= self._local_offset(seconds)
+        elif zone != "Z":
+            zone = zone.replace(":", "")
+            offset = int(zone[1:3]) * 3600 + int(zone[3:5]) * 60
+            seconds -= offset if zone[0] == "+" else -offset
+        millis = int((fraction + "00")[:3]) if fraction else 0
+        return seconds * 1000 + millis
+
+    def _parse_syslog(self, match):
+        month, day, hour, minute, second = match.groups()
+        now = time.time()
+        year = time.gmtime(now).tm_year
+        month = MONTHS[month]
+        seconds = self._day((year, month, day), year, month, int(day))
+        seconds += int(hour) * 3600 + int(minute) * 60 + int(second)
+        seconds -= self._local_offset(seconds)
+        if seconds > now + 86400:
+            # Syslog has no year, so a date ahead of us is from last year
+            seconds = self._day((year - 1, month, day), year - 1, month, int(day))
+            seconds += int(hour) * 3600 + int(minute) * 60 + int(second)
+            seconds -= self._local_offset(seconds)
+        return seconds * 1000
+
+    def _parse_clf(self, match):
+        day, month, year, hour, minute, second, zone = match.groups()
+        month = MONTHS[month]
+        seconds = self._day((year, month, day), int(year), month, int(day))
+        seconds += int(hour) * 3600 + int(minute) * 60 + int(second)
+        offset = int(zone[1:3]) * 3600 + int(zone[3:5]) * 60
+        seconds -= offset if zone[0] == "+" else -offset
+        return seconds * 1000
+
+    def _day(self, key, year, month, day):
+        seconds = self._days.get(key)
+        if seconds is None:
+            if len(self._days) > 1024:
+                self._days.clear()
+            seconds = calendar.timegm((year, month, day, 0, 0, 0))
+            self._days[key] = seconds
+        return seconds
+
+    def _local_offset(self, wall_seconds):
+        # Wall clock seconds read as UTC are off by the offset, which can put
+        # them on the other side of a daylight saving change. The offset at
+        # the UTC time they give is right
+        guess = wall_seconds - self._utc_offset(wall_seconds)
+        return self._utc_offset(guess)
+
+    def _utc_offset(self, seconds):
+        hour = seconds // 3600
+        offset = self._offsets.get(hour)
+        if offset is None:
+            if len(self._offsets) > 1024:
+                self._offsets.clear()
+            offset = time.localtime(seconds).tm_gmtoff
+            self._offsets[hour] = offset
+        return offset
+
+
+class Checkpoint(object):
+    """Acknowledged read position of a followed file for a log stream. Saves
+    are coalesced so that at most one fsynced write and atomic rename happens
+    per interval"""
+
+    def __init__(self, path, interval=CHECKPOINT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self._position = None
+        self._written = None
+        self._last_write = 0
+        self._lock = Lock()
+
+    @classmethod
+    def for_stream(cls, checkpoint_dir, file_name, group_name, stream_name):
+        key = "\0".join([os.path.abspath(file_name), group_name, stream_name])
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        name = os.path.basename(file_name) + "-" + digest + ".json"
+        return cls(os.path.join(checkpoint_dir, name))
+
+    def load(self):
+        """Returns the saved position as an (inode, offset) tuple or None"""
+        try:
+            with open(self.path) as checkpoint_file:
+                data = json.load(checkpoint_file)
+            self._written = (data["inode"], data["offset"])
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        self._position = self._written
+        return self._position
+
+    def save(self, position):
+        with self._lock:
+            self._position = position
+            if time.time() - self._last_write >= self.interval:
+                self._write()
+
+    def flush(self):
+        with self._lock:
+            self._write()
+
+    def due(self):
+        """Returns the time an unwritten position should be written or None"""
+        with self._lock:
+            if self._position is None or self._position == self._written:
+                return None
+            return self._last_write + self.interval
+
+    def _write(self):
+        if self._position is None or self._position == self._written:
+            return
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as checkpoint_file:
+            json.dump(
+                {"inode": self._position[0], "offset": self._position[1]},
+                checkpoint_file,
+            )
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.rename(tmp_path, self.path)
+        self._written = self._position
+        self._last_write = time.time()
+
+
+class Spool(object):
+    """Append-only on-disk overflow queue for a log stream. Messages are
+    written to segment files as utf-8 prefixed with their timestamp and
+    length and read back a whole segment at a time. Each segment remembers
+    the queue index of its first message so that dropped segments can be
+    accounted for"""
+
+    def __init__(self, directory, max_bytes, segment_bytes=SPOOL_SEGMENT_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.bytes = 0
+        self._segments = deque()
+        self._writer = None
+        self._sequence = 0
+        if os.path.isdir(directory):
+            # Checkpoints make the followed files the source of truth after a
+            # restart, so leftovers from an earlier run are not replayed
+            for name in os.listdir(directory):
+                if name.endswith(".seg"):
+                    os.remove(os.path.join(directory, name))
+        else:
+            os.makedirs(directory)
+
+    def __len__(self):
+        return len(self._segments)
+
+    def full(self, size):
+        return self.bytes + size + SPOOL_RECORD.size > self.max_bytes
+
+    def head_bytes(self):
+        return self._segments[0][3] if self._segments else 0
+
+    def append(self, timestamp, data, index):
+        if not self._writer or self._segments[-1][3] >= self.segment_bytes:
+            self._roll(index)
+        self._writer.write(SPOOL_RECORD.pack(timestamp, len(data)))
+        self._writer.write(data)
+        segment = self._segments[-1]
+        segment[2] += 1
+        segment[3] += len(data) + SPOOL_RECORD.size
+        self.bytes += len(data) + SPOOL_RECORD.size
+
+    def pop_segment(self):
+        """Remove the oldest segment and return its (timestamp, message, size)
+        tuples"""
+        path, _, _, _ = self._close_head()
+        entries = []
+        with open(path, "rb") as segment_file:
+            data = segment_file.read()
+        os.remove(path)
+        position = 0
+        while position < len(data):
+            timestamp, length = SPOOL_RECORD.unpack_from(data, position)
+            position += SPOOL_RECORD.size
+            entries.append(
+                (
+                    timestamp,
+                    data[position : position + length].decode("utf-8"),
+                    length + EVENT_OVERHEAD,
+                )
+            )
+            position += length
+        return entries
+
+    def drop_segment(self):
+        """Remove the oldest segment unread and return the queue index of its
+        first message and the number of messages in it"""
+        path, first_index, count, _ = self._close_head()
+        os.remove(path)
+        return first_index, count
+
+    def _close_head(self):
+        segment = self._segments.popleft()
+        if not self._segments and self._writer:
+            self._writer.close()
+            self._writer = None
+        elif self._writer:
+            self._writer.flush()
+        self.bytes -= segment[3]
+        return segment
+
+    def _roll(self, index):
+        if self._writer:
+            self._writer.close()
+        self._sequence += 1
+        path = os.path.join(self.directory, "%012d.seg" % self._sequence)
+        self._writer = open(path, "wb")
+        self._segments.append([path, index, 0, 0])
+
+
+class LogTransport(object):
+    """CloudWatch Logs client shared by all LogSenders of a process. The
+    client is safe to use from many threads and keeps its keep-alive
+    connections in one pool sized for the send workers. With gzip
+    compression PutLogEvents request bodies are compressed before signing
+    and if the endpoint rejects a compressed body, compression is turned
+    off for good and the request is sent again uncompressed. Raw and on the
+    wire body bytes are counted to see the saving"""
+
+    def __init__(
+        self,
+        compression=COMPRESSION_NONE,
+        pool_size=SEND_WORKERS,
+        min_compress_bytes=COMPRESSION_MIN_BYTES,
+    ):
+        self.compression = compression
+        self.min_compress_bytes = min_compress_bytes
+        self.requests = 0
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self._lock = Lock()
+        self.client = Session().client(
+            "logs",
+            region_name=region(),
+            config=Config(max_pool_connections=pool_size, tcp_keepalive=True),
+        )
+        self.client.meta.events.register(
+            "before-sign.cloudwatch-logs.PutLogEvents", self._compress
+        )
+
+    def _compress(self, request, **kwargs):
+        # Runs again for every retry with a freshly serialized request
+        body = request.data or b""
+        if not isinstance(body, bytes):
+            body = body.encode("utf-8")
+        raw_bytes = len(body)
+        if (
+            self.compression == COMPRESSION_GZIP
+            and raw_bytes >= self.min_compress_bytes
+        ):
+            body = gzip.compress(body, compresslevel=COMPRESSION_LEVEL)
+            request.data = body
+            request.headers["Content-Encoding"] = "gzip"
+        with self._lock:
+            self.requests += 1
+            self.raw_bytes += raw_bytes
+            self.wire_bytes += len(body)
+
+    def create_log_group(self, **kwargs):
+        return self.client.create_log_group(**kwargs)
+
+    def create_log_stream(self, **kwargs):
+        return self.client.create_log_stream(**kwargs)
+
+    def put_log_events(self, **kwargs):
+        compressed = self.compression == COMPRESSION_GZIP
+        try:
+            return self.client.put_log_events(**kwargs)
+        except ClientError as err:
+            if not compressed or not _rejects_compression(err):
+                raise
+            sys.stderr.write(
+                "Compressed request rejected, sending uncompressed: " + str(err) + "\n"
+            )
+            self.compression = COMPRESSION_NONE
+            return self.client.put_log_events(**kwargs)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "rawBytes": self.raw_bytes,
+                "wireBytes": self.wire_bytes,
+            }
+
+
+def _rejects_compression(err):
+    response = err.response
+    return (
+        response.get("Error", {}).get("Code") in COMPRESSION_REJECTED_ERRORS
+        or response.get("ResponseMetadata", {}).get("HTTPStatusCode") == 415
+    )
+
+
+class Histogram(object):
+    """Counts of observed values in cumulative buckets for Prometheus"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self._lock = Lock()
+
+    def __len__(self):
+        return sum(self.counts)
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        ret = []
+        cumulative = 0
+        for bucket, count in zip(self.buckets + ["+Inf"], counts):
+            cumulative += count
+            bucket_labels = dict(labels)
+            bucket_labels["le"] = str(bucket)
+            ret.append((name + "_bucket", bucket_labels, cumulative))
+        ret.append((name + "_sum", labels, total))
+        ret.append((name + "_count", labels, cumulative))
+        return ret
+
+
+class EventBuffer(object):
+    """Queued (timestamp, message, size) entries that fit in one
+    PutLogEvents batch. Sizes are the utf-8 length of the message plus the
+    per event overhead so that batches can be cut without encoding again"""
+
+    def __init__(self):
+        self.entries = deque()
+        self.bytes = 0
+        self.first = None
+        self.last = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def fits(self, timestamp, size, max_bytes, max_events):
+        if not self.entries:
+            return True
+        return (
+            len(self.entries) < max_events
+            and self.bytes + size <= max_bytes
+            and max(self.last, timestamp) - min(self.first, timestamp) < MAX_BATCH_SPAN
+        )
+
+    def full(self, max_bytes, max_events):
+        return len(self.entries) >= max_events or self.bytes >= max_bytes
+
+    def append(self, entry):
+        timestamp, _, size = entry
+        if not self.entries:
+            self.first = self.last = timestamp
+        else:
+            self.first = min(self.first, timestamp)
+            self.last = max(self.last, timestamp)
+        self.entries.append(entry)
+        self.bytes += size
+
+    def popleft(self):
+        entry = self.entries.popleft()
+        self.bytes -= entry[2]
+        return entry
+
+    def events(self):
+        """PutLogEvents events in chronological order. Empty messages are
+        rejected by CloudWatch and left out"""
+        events = [
+            {"timestamp": timestamp, "message": message}
+            for timestamp, message, _ in self.entries
+            if message
+        ]
+        events.sort(key=itemgetter("timestamp"))
+        return events
 
 
 class LogSender(object):
-    def __init__(self, file_name, group=None, stream=None):
+    def __init__(
+        self,
+        file_name,
+        group=None,
+        stream=None,
+        checkpoint=None,
+        start_thread=True,
+        max_queue_bytes=MAX_QUEUE_BYTES,
+        spool_dir=None,
+        spool_bytes=SPOOL_BYTES,
+        overflow=OVERFLOW_DROP_OLDEST,
+        timestamp_format=None,
+        batch_bytes=MAX_BATCH_BYTES,
+        batch_events=MAX_BATCH_EVENTS,
+        scheduler=None,
+        transport=None,
+    ):
         self._lock = Lock()
-        self._send_lock = Lock()
+        self.transport = transport or LogTransport()
+        self._space = Condition(self._lock)
         if group:
             self.group_name = group
         else:
             self.group_name = resolve_stack_name()
-        self._messages = deque()
+        # Full buffers waiting to be sent followed by the one being filled
+        self._buffers = deque()
         if stream:
             self.stream_name = stream
         else:
-            self.stream_name = (
-                resolve_instance_id()
-                + "|"
-                + file_name.replace(":", "_").replace("*", "_")
+            self.stream_name = default_stream_name(file_name)
+        self._create_group_and_stream()
+        self.checkpoint = checkpoint
+        self.timestamp_parser = (
+            TimestampParser(timestamp_format) if timestamp_format else None
+        )
+        self.max_queue_bytes = max_queue_bytes
+        self.overflow = overflow
+        self.batch_bytes = batch_bytes
+        self.batch_events = batch_events
+        self.scheduler = scheduler
+        self._batches = deque()
+        self._first_queued = None
+        self._retry_at = 0
+        self._queue_bytes = 0
+        self._spool = None
+        if spool_dir:
+            key = "\0".join([self.group_name, self.stream_name]).encode("utf-8")
+            self._spool = Spool(
+                os.path.join(spool_dir, hashlib.sha1(key).hexdigest()[:16]),
+                spool_bytes,
             )
+        self.dropped = 0
+        self.bytes_queued = 0
+        self.puts = 0
+        self.batch_puts = 0
+        self.put_errors = 0
+        self.throttles = 0
+        self.batch_event_counts = Histogram(BATCH_EVENT_BUCKETS)
+        self.batch_byte_counts = Histogram(BATCH_BYTE_BUCKETS)
+        self.put_latency = Histogram(PUT_LATENCY_BUCKETS)
+        self._queued = 0
+        self._sent = 0
+        self._inflight = 0
+        self._marks = deque()
+        self._skipped = deque()
+        self.send(str(info()))
+        self._do_send()
+        if start_thread and not self.scheduler:
+            FlushScheduler().add_sender(self)
+            self.scheduler.start()
+
+    def send(self, line, timestamp=None):
+        """Queue a line to be sent. The event timestamp is parsed from the line
+        if a timestamp parser is set and otherwise the given one in
+        milliseconds or the time the line was queued"""
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", "replace")
+        message = line.rstrip()
+        timestamp = self._timestamp(message, timestamp)
+        # Encode once outside the lock, only the size is kept for memory
+        data = message.encode("utf-8", "replace")
+        if len(data) > MAX_EVENT_BYTES:
+            # CloudWatch rejects the whole batch if one event is too large
+            message = data[:MAX_EVENT_BYTES].decode("utf-8", "ignore")
+            data = message.encode("utf-8")
+        size = len(data) + EVENT_OVERHEAD
         try:
-            logs().create_log_group(logGroupName=self.group_name)
+            self._lock.acquire()
+            while self._overflows(size):
+                if self.overflow == OVERFLOW_BLOCK:
+                    if self.scheduler and current_thread() is self.scheduler:
+                        # Lines stages pass on from tick must not stop the
+                        # thread that frees the space
+                        break
+                    self._space.wait(1)
+                elif self.overflow == OVERFLOW_DROP_NEWEST:
+                    self.dropped += 1
+                    return
+                else:
+                    self._drop_oldest()
+            if self._spool is not None and (
+                len(self._spool) or self._queue_bytes + size > self.max_queue_bytes
+            ):
+                self._spool.append(timestamp, data, self._queued)
+            else:
+                self._append((timestamp, message, size))
+            self._queued += 1
+            self.bytes_queued += size
+        finally:
+            self._lock.release()
+
+    def _append(self, entry):
+        timestamp, _, size = entry
+        if not self._buffers:
+            self._first_queued = time.time()
+            self._buffers.append(EventBuffer())
+            self.wake()
+        buffer = self._buffers[-1]
+        if not buffer.fits(timestamp, size, self.batch_bytes, self.batch_events):
+            buffer = EventBuffer()
+            self._buffers.append(buffer)
+        buffer.append(entry)
+        self._queue_bytes += size
+        if len(self._buffers) == 2 and len(buffer) == 1:
+            # A full batch is waiting
+            self.wake()
+
+    def _overflows(self, size):
+        if self._queue_bytes + size <= self.max_queue_bytes and not (
+            self._spool is not None and len(self._spool)
+        ):
+            return False
+        if self._spool is None:
+            return bool(self._buffers)
+        return self._spool.full(size) and len(self._spool) > 0
+
+    def _drop_oldest(self):
+        if self._spool is not None and len(self._spool):
+            first_index, count = self._spool.drop_segment()
+            self._skipped.append((first_index, count))
+            self.dropped += count
+        else:
+            # Without a spool the queue is contiguous: in flight messages come
+            # first, then earlier drops, then the in memory messages
+            head_index = (
+                self._sent + self._inflight + sum(count for _, count in self._skipped)
+            )
+            buffer = self._buffers[0]
+            self._queue_bytes -= buffer.popleft()[2]
+            if not buffer:
+                self._buffers.popleft()
+            self._skipped.append((head_index, 1))
+            self.dropped += 1
+
+    def _refill(self):
+        # A segment is read back whole, also when it alone is over the memory
+        # limit, so that the spool drains whatever the limit is
+        while (
+            self._spool is not None
+            and len(self._spool)
+            and (
+                not self._buffers
+                or self._queue_bytes + self._spool.head_bytes() <= self.max_queue_bytes
+            )
+        ):
+            for entry in self._spool.pop_segment():
+                self._append(entry)
+
+    def _timestamp(self, message, timestamp):
+        now = int(time.time() * 1000)
+        if self.timestamp_parser:
+            parsed = self.timestamp_parser.parse(message)
+            # CloudWatch rejects events too far in the past or future
+            if parsed and now - MAX_EVENT_AGE < parsed < now + MAX_EVENT_AHEAD:
+                return parsed
+        return now if timestamp is None else timestamp
+
+    def mark(self, position):
+        """Record that everything up to position has been queued. The position
+        is saved to the checkpoint once all of those lines have been sent"""
+        with self._lock:
+            if self._marks or self._sent < self._queued:
+                self._marks.append((self._queued, position))
+                return
+        # Nothing is waiting to be sent
+        if self.checkpoint:
+            self.checkpoint.save(position)
+
+    def idle(self):
+        """True if nothing is queued, spooled or in flight"""
+        with self._lock:
+            return not (
+                self._buffers
+                or self._batches
+                or (self._spool is not None and len(self._spool))
+            )
+
+    def full_batch_waiting(self):
+        # Read without the lock, a stale answer only delays the decision
+        return len(self._buffers) > 1
+
+    def wake(self):
+        if self.scheduler:
+            self.scheduler.wake()
+
+    def flush_due(self, max_latency):
+        """Returns the time this sender should next be flushed or None if there
+        is nothing to send"""
+        with self._lock:
+            if any(batch[2] == BATCH_PENDING for batch in self._batches):
+                return self._retry_at
+            if len(self._batches) >= MAX_BATCHES_IN_FLIGHT:
+                # No batch can be cut before the oldest one is done, which
+                # wakes the scheduler
+                return None
+            if self._spool is not None and len(self._spool):
+                return self._retry_at
+            if not self._buffers:
+                return None
+            if len(self._buffers) > 1 or self._buffers[0].full(
+                self.batch_bytes, self.batch_events
+            ):
+                return self._retry_at
+            return max(self._first_queued + max_latency, self._retry_at)
+
+    def _do_send(self):
+        with self._lock:
+            self._refill()
+            # Cut the next batch while the previous one may still be in flight
+            if len(self._batches) < MAX_BATCHES_IN_FLIGHT:
+                buffer = self._cut_batch()
+                if buffer:
+                    self._batches.append([len(buffer), buffer, BATCH_PENDING])
+                    self.batch_event_counts.observe(len(buffer))
+                    self.batch_byte_counts.observe(buffer.bytes)
+        while True:
+            with self._lock:
+                batch = next(
+                    (batch for batch in self._batches if batch[2] == BATCH_PENDING),
+                    None,
+                )
+                if not batch:
+                    return
+                batch[2] = BATCH_IN_FLIGHT
+            events = batch[1]
+            if isinstance(events, EventBuffer):
+                # Only the sender holding the batch in flight builds the
+                # request, outside the lock
+                events = batch[1] = events.events()
+            if events:
+                self.batch_puts += 1
+                try:
+                    self._put_log_events(events)
+                except:
+                    # The batch keeps its place in line to keep acknowledgements
+                    # in order
+                    with self._lock:
+                        batch[2] = BATCH_PENDING
+                    self._retry_at = time.time() + RETRY_DELAY
+                    return
+            done = 0
+            with self._lock:
+                batch[2] = BATCH_DONE
+                while self._batches and self._batches[0][2] == BATCH_DONE:
+                    done += self._batches.popleft()[0]
+            self._retry_at = 0
+            if done:
+                self._acknowledge(done)
+
+    def _cut_batch(self):
+        # Swap out the oldest buffer, it already fits in one batch
+        if not self._buffers:
+            return None
+        buffer = self._buffers.popleft()
+        self._queue_bytes -= buffer.bytes
+        self._inflight += len(buffer)
+        return buffer
+
+    def _acknowledge(self, count):
+        position = None
+        with self._lock:
+            self._sent += count
+            self._inflight -= count
+            # Spooled segments dropped on overflow count as sent once
+            # everything queued before them has been sent
+            while self._skipped and self._skipped[0][0] <= self._sent:
+                self._sent += self._skipped.popleft()[1]
+            self._space.notify_all()
+            while self._marks and self._marks[0][0] <= self._sent:
+                position = self._marks.popleft()[1]
+        if position is not None and self.checkpoint:
+            self.checkpoint.save(position)
+
+    @retry(tries=3, delay=1, backoff=2)
+    def _put_log_events(self, events):
+        # Sequence tokens are no longer needed, so there is no
+        # DescribeLogStreams round trip and puts to a stream may overlap
+        self.puts += 1
+        start = time.time()
+        try:
+            log_response = self.transport.put_log_events(
+                logGroupName=self.group_name,
+                logStreamName=self.stream_name,
+                logEvents=events,
+            )
+        except ClientError as err:
+            self.put_errors += 1
+            code = err.response.get("Error", {}).get("Code")
+            if code == "ThrottlingException":
+                self.throttles += 1
+            if code == "ResourceNotFoundException":
+                # Group or stream deleted under us, recreate and retry
+                self._create_group_and_stream()
+            elif code in UNRETRYABLE_PUT_ERRORS:
+                # Retrying the same batch can not succeed
+                sys.stderr.write(
+                    "Dropping " + str(len(events)) + " events: " + str(err) + "\n"
+                )
+                self.dropped += len(events)
+                return
+            raise
+        except BaseException:
+            self.put_errors += 1
+            raise
+        finally:
+            self.put_latency.observe(time.time() - start)
+        if "CLOUDWATCH_LOG_DEBUG" in os.environ:
+            print(
+                "Sent "
+                + str(len(events))
+                + " messages to "
+                + self.stream_name
+                + " "
+                + json.dumps(self.transport.stats())
+            )
+            if log_response and "rejectedLogEventsInfo" in log_response:
+                print("Rejected " + json.dumps(log_response["rejectedLogEventsInfo"]))
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        """Send everything queued before shutting down. Returns False if that
+        did not succeed within timeout seconds"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self._lock:
+                if (
+                    not self._buffers
+                    and not self._batches
+                    and not (self._spool is not None and len(self._spool))
+                ):
+                    return True
+                sendable = any(
+                    batch[2] == BATCH_PENDING for batch in self._batches
+                ) or (
+                    len(self._batches) < MAX_BATCHES_IN_FLIGHT
+                    and (
+                        self._buffers or (self._spool is not None and len(self._spool))
+                    )
+                )
+            if sendable:
+                time.sleep(max(0, min(self._retry_at, deadline) - time.time()))
+                self._do_send()
+            else:
+                # Wait for batches in flight on the scheduler's workers
+                time.sleep(0.01)
+        return False
+
+    def stats(self):
+        """Prometheus samples of this sender as (name, labels, value)
+        tuples"""
+        labels = {"group": self.group_name, "stream": self.stream_name}
+        with self._lock:
+            samples = [
+                ("lines_queued_total", self._queued),
+                ("bytes_queued_total", self.bytes_queued),
+                ("lines_sent_total", self._sent),
+                ("queue_depth", self._queued - self._sent),
+                ("queue_bytes", self._queue_bytes),
+                ("spool_bytes", self._spool.bytes if self._spool is not None else 0),
+                ("dropped_total", self.dropped),
+                ("puts_total", self.puts),
+                ("put_errors_total", self.put_errors),
+                ("put_retries_total", self.puts - self.batch_puts),
+                ("throttles_total", self.throttles),
+            ]
+        ret = [(name, labels, value) for name, value in samples]
+        ret.extend(self.batch_event_counts.samples("batch_events", labels))
+        ret.extend(self.batch_byte_counts.samples("batch_bytes", labels))
+        ret.extend(self.put_latency.samples("put_latency_seconds", labels))
+        return ret
+
+    def _create_group_and_stream(self):
+        try:
+            self.transport.create_log_group(logGroupName=self.group_name)
         except BaseException:
             pass
         try:
-            logs().create_log_stream(
+            self.transport.create_log_stream(
                 logGroupName=self.group_name, logStreamName=self.stream_name
             )
         except BaseException:
             pass
-        self.token = None
-        self.send(str(info()))
-        self._do_send()
-        self._stop_flag = Event()
-        self._thread = IntervalThread(self._stop_flag, 2, self._do_send)
-        self._thread.start()
 
-    def send(self, line):
-        try:
-            self._lock.acquire()
-            if isinstance(line, bytes):
-                line = line.decode("utf-8", "replace")
-            self._messages.append(line.rstrip())
-            if "CLOUDWATCH_LOG_DEBUG" in os.environ:
-                print("Queued message")
-        finally:
-            self._lock.release()
 
-    def _do_send(self):
-        events = []
+class ShardedSender(object):
+    """Spreads the lines of one input over several LogSenders, each with
+    its own stream, to get past the put rate limit of a single stream.
+    Lines go to one shard until it has a full batch waiting and then to the
+    next, so order is kept within each stream. A read position is saved to
+    checkpoint once every shard has sent the lines before it"""
+
+    def __init__(self, shards, checkpoint=None):
+        self.shards = shards
+        self.checkpoint = checkpoint
+        self._lock = Lock()
+        self._current = 0
+        self._sequence = 0
+        self._positions = deque()
+        self._acknowledged = [0] * len(shards)
+        if checkpoint:
+            for index, shard in enumerate(shards):
+                shard.checkpoint = _ShardCheckpoint(self, index)
+
+    def send(self, line, timestamp=None):
+        shard = self.shards[self._current]
+        shard.send(line, timestamp=timestamp)
+        if shard.full_batch_waiting():
+            self._current = (self._current + 1) % len(self.shards)
+
+    def mark(self, position):
+        with self._lock:
+            self._sequence += 1
+            sequence = self._sequence
+            self._positions.append((sequence, position))
+        # Shards save the sequence number once they have sent up to it
+        for shard in self.shards:
+            shard.mark(sequence)
+
+    def wake(self):
+        for shard in self.shards:
+            shard.wake()
+
+    def _saved(self, index, sequence):
+        position = None
+        with self._lock:
+            self._acknowledged[index] = sequence
+            done = min(self._acknowledged)
+            while self._positions and self._positions[0][0] <= done:
+                position = self._positions.popleft()[1]
+        if position is not None:
+            self.checkpoint.save(position)
+
+
+class _ShardCheckpoint(object):
+    """Stands in for the checkpoint of one shard of a ShardedSender. The
+    first shard also passes on writing the real checkpoint"""
+
+    def __init__(self, sharded_sender, index):
+        self.sharded_sender = sharded_sender
+        self.index = index
+
+    def save(self, sequence):
+        self.sharded_sender._saved(self.index, sequence)
+
+    def due(self):
+        if self.index:
+            return None
+        return self.sharded_sender.checkpoint.due()
+
+    def flush(self):
+        if not self.index:
+            self.sharded_sender.checkpoint.flush()
+
+
+class FlushScheduler(Thread):
+    """Flushes LogSenders on a pool of workers as soon as a full batch is
+    queued or when the oldest queued line has waited max_latency seconds.
+    While a batch is in flight the next one is already cut, so a sender
+    can have MAX_BATCHES_IN_FLIGHT flushes outstanding. The thread sleeps
+    until the next deadline of a sender, stage or checkpoint or until woken
+    by a sender, but at most flush_interval seconds"""
+
+    def __init__(
+        self,
+        pool=None,
+        flush_interval=FLUSH_INTERVAL,
+        max_latency=MAX_LATENCY,
+        workers=SEND_WORKERS,
+    ):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.flush_interval = flush_interval
+        self.max_latency = max_latency
+        self._pool = pool or ThreadPoolExecutor(max_workers=workers)
+        self._senders = []
+        self._stages = []
+        self._outstanding = {}
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._stopped = Event()
+
+    def add_sender(self, log_sender):
+        log_sender.scheduler = self
+        self._senders.append(log_sender)
+        self.wake()
+
+    def add_stage(self, stage):
+        stage.scheduler = self
+        self._stages.append(stage)
+
+    def remove_sender(self, log_sender):
+        self._senders.remove(log_sender)
+
+    def remove_stage(self, stage):
+        self._stages.remove(stage)
+
+    def submit(self, function, *args):
+        """Run function on the worker pool, for stages with blocking work
+        that must not hold up flushing. Returns the future or None if the
+        pool has been shut down"""
         try:
-            self._lock.acquire()
-            if len(self._messages) == 0:
+            return self._pool.submit(function, *args)
+        except RuntimeError:
+            # The pool shuts down when the interpreter exits
+            self.stop()
+            return None
+
+    def wake(self):
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    def run(self):
+        while not self._stopped.is_set():
+            self._wakeup.clear()
+            now = time.time()
+            deadline = now + self.flush_interval
+            for stage in list(self._stages):
+                try:
+                    due = stage.tick()
+                except Exception as err:
+                    sys.stderr.write("Failed to run log stage: " + str(err) + "\n")
+                    continue
+                if due:
+                    deadline = min(deadline, due)
+            for log_sender in list(self._senders):
+                # One failing sender must not stop flushing the others
+                try:
+                    deadline = self._schedule(log_sender, now, deadline)
+                except Exception as err:
+                    sys.stderr.write(
+                        "Failed to flush "
+                        + log_sender.stream_name
+                        + ": "
+                        + str(err)
+                        + "\n"
+                    )
+            self._wakeup.wait(max(0, deadline - time.time()))
+
+    def _schedule(self, log_sender, now, deadline):
+        """Submit a flush of log_sender if one is due and return deadline
+        moved up to when the sender or its checkpoint is next due"""
+        if log_sender.checkpoint:
+            due = log_sender.checkpoint.due()
+            if due and due <= now:
+                log_sender.checkpoint.flush()
+            elif due:
+                deadline = min(deadline, due)
+        due = log_sender.flush_due(self.max_latency)
+        if due is None:
+            return deadline
+        if due > now:
+            return min(deadline, due)
+        if self._outstanding.get(log_sender, 0) < MAX_BATCHES_IN_FLIGHT:
+            self._submit(log_sender)
+        return deadline
+
+    def _submit(self, log_sender):
+        future = self.submit(log_sender._do_send)
+        if future is None:
+            return
+        with self._lock:
+            self._outstanding[log_sender] = self._outstanding.get(log_sender, 0) + 1
+        future.add_done_callback(lambda _: self._done(log_sender))
+
+    def _done(self, log_sender):
+        with self._lock:
+            self._outstanding[log_sender] -= 1
+            if not self._outstanding[log_sender]:
+                del self._outstanding[log_sender]
+        self.wake()
+
+
+class LogStage(object):
+    """A step between reading lines and queuing them in a LogSender. Stages
+    are chained with the LogSender as the last one and pass lines on with
+    send, read positions with mark and get a periodic tick from the flushing
+    thread for time based work"""
+
+    def __init__(self, next_stage):
+        self.next_stage = next_stage
+        self.scheduler = None
+        self._outgoing = deque()
+        self._passing = Lock()
+
+    def send(self, line, timestamp=None):
+        self.next_stage.send(line, timestamp=timestamp)
+
+    def mark(self, position):
+        self.next_stage.mark(position)
+
+    def wake(self):
+        self.next_stage.wake()
+
+    def tick(self):
+        """Called from the flushing thread. Returns the next time the stage
+        needs a tick or None"""
+        return None
+
+    def close(self):
+        """Called when the input has ended to pass on anything held back"""
+        pass
+
+    def _pass_on(self, block=True):
+        """Send the lines and marks in _outgoing to the next stage in order.
+        Stages queue them under their own lock and call this after releasing
+        it, since the next stage may block waiting for queue space. Without
+        block the thread already passing lines on picks up the rest"""
+        while self._outgoing:
+            if not self._passing.acquire(block):
                 return
-            counter = 0
-            while len(self._messages) > 0 and counter < 1048576 and len(events) < 10000:
-                message = self._messages.popleft()
-                counter = counter + len(message.encode("utf-8", "replace")) + 26
-                if counter > 1048576:
-                    self._messages.appendleft(message)
-                elif message:
-                    event = {}
-                    event["timestamp"] = int(time.time() * 1000)
-                    event["message"] = message
-                    events.append(event)
-        finally:
-            self._lock.release()
-        if len(events) == 0:
+            try:
+                while self._outgoing:
+                    line, timestamp, position = self._outgoing.popleft()
+                    if line is None:
+                        self.next_stage.mark(position)
+                    else:
+                        self.next_stage.send(line, timestamp=timestamp)
+            finally:
+                self._passing.release()
+
+
+class MultilineAssembler(LogStage):
+    """Joins physical lines into multi-line events such as stack traces.
+    A line starts a new event if it matches start_pattern or, when only
+    continuation_pattern is given, if it does not match that. Events are
+    cut at max_lines or max_bytes and sent once flush_timeout seconds have
+    passed without a new line"""
+
+    def __init__(
+        self,
+        next_stage,
+        start_pattern=None,
+        continuation_pattern=None,
+        max_lines=MULTILINE_MAX_LINES,
+        max_bytes=MULTILINE_MAX_BYTES,
+        flush_timeout=MULTILINE_TIMEOUT,
+    ):
+        LogStage.__init__(self, next_stage)
+        self.start_pattern = re.compile(start_pattern) if start_pattern else None
+        self.continuation_pattern = (
+            re.compile(continuation_pattern) if continuation_pattern else None
+        )
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.flush_timeout = flush_timeout
+        self._lock = Lock()
+        self._lines = []
+        self._bytes = 0
+        self._timestamp = None
+        self._last_line = 0
+        self._position = None
+
+    def _starts_event(self, line):
+        if self.start_pattern and self.start_pattern.match(line):
+            return True
+        if self.continuation_pattern:
+            return not self.continuation_pattern.match(line)
+        return not self.start_pattern
+
+    def send(self, line, timestamp=None):
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", "replace")
+        line = line.rstrip("\r\n")
+        size = len(line) if line.isascii() else len(line.encode("utf-8"))
+        with self._lock:
+            self._last_line = time.time()
+            if self._lines and (
+                self._starts_event(line)
+                or len(self._lines) >= self.max_lines
+                or self._bytes + size + 1 > self.max_bytes
+            ):
+                self._flush()
+            if not self._lines:
+                self._timestamp = (
+                    timestamp if timestamp is not None else int(self._last_line * 1000)
+                )
+                self.wake()
+            self._lines.append(line)
+            self._bytes += size + 1
+        self._pass_on()
+
+    def mark(self, position):
+        with self._lock:
+            if self._lines:
+                # Buffered lines precede the position, so hold on to it until
+                # they have been passed on
+                self._position = position
+            else:
+                self._outgoing.append((None, None, position))
+        self._pass_on()
+
+    def tick(self):
+        due = None
+        with self._lock:
+            if self._lines:
+                if time.time() - self._last_line >= self.flush_timeout:
+                    self._flush()
+                else:
+                    due = self._last_line + self.flush_timeout
+        # The flushing thread must not wait for the reading thread
+        self._pass_on(block=False)
+        return due
+
+    def close(self):
+        with self._lock:
+            if self._lines:
+                self._flush()
+        self._pass_on()
+
+    def _flush(self):
+        self._outgoing.append(("\n".join(self._lines), self._timestamp, None))
+        self._lines = []
+        self._bytes = 0
+        if self._position is not None:
+            self._outgoing.append((None, None, self._position))
+            self._position = None
+
+
+class LineFilter(LogStage):
+    """Drops, samples and redacts lines before they are queued. A line is
+    kept if it matches one of includes, when given, and none of excludes.
+    samples is a list of (rate, pattern) tuples: of the lines matching a
+    pattern only the given fraction is kept, evenly spaced. Matches of the
+    redact patterns are replaced with the replacement. Each list of
+    patterns is combined into a single alternation where possible so a
+    line is scanned once per list"""
+
+    def __init__(
+        self,
+        next_stage,
+        includes=None,
+        excludes=None,
+        samples=None,
+        redact=None,
+        replacement=REDACTED,
+    ):
+        LogStage.__init__(self, next_stage)
+        self.include_pattern = _PatternSet(includes)
+        self.exclude_pattern = _PatternSet(excludes)
+        self.sample_rates = [float(rate) for rate, _ in samples or []]
+        self.sample_pattern = _PatternSet(
+            [pattern for _, pattern in samples or []], named=True
+        )
+        self.redact_pattern = _PatternSet(redact)
+        self.replacement = replacement
+        self._credits = [0.0] * len(self.sample_rates)
+        self.filtered = 0
+        self.sampled_out = 0
+        self.redacted = 0
+
+    def send(self, line, timestamp=None):
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", "replace")
+        if (self.include_pattern and not self.include_pattern.search(line)) or (
+            self.exclude_pattern and self.exclude_pattern.search(line)
+        ):
+            self.filtered += 1
             return
+        if self.sample_pattern:
+            index = self.sample_pattern.index(line)
+            if index is not None:
+                # Rounded so that rates like 0.1 add up to exactly one
+                self._credits[index] = round(
+                    self._credits[index] + self.sample_rates[index], 9
+                )
+                if self._credits[index] < 1:
+                    self.sampled_out += 1
+                    return
+                self._credits[index] -= 1
+        if self.redact_pattern and self.redact_pattern.search(line):
+            for pattern in self.redact_pattern.patterns:
+                line = pattern.sub(self.replacement, line)
+            self.redacted += 1
+        self.next_stage.send(line, timestamp=timestamp)
+
+
+class MetricAggregate(object):
+    """Count, sum, minimum and maximum of a metric over an interval. Values
+    for percentiles are kept in a reservoir sample of at most max_samples"""
+
+    def __init__(self, max_samples=METRIC_SAMPLES):
+        self.max_samples = max_samples
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.samples = []
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if len(self.samples) < self.max_samples:
+            self.samples.append(value)
+        else:
+            index = random.randrange(self.count)
+            if index < self.max_samples:
+                self.samples[index] = value
+
+    def percentile(self, percent):
+        samples = sorted(self.samples)
+        index = int(round(percent / 100.0 * (len(samples) - 1)))
+        return samples[index]
+
+
+class MetricExtractor(LogStage):
+    """Parses JSON lines and aggregates the numeric values of fields into
+    per interval statistics for each combination of dimension fields.
+    Fields and dimensions may be dotted paths into nested objects. At the
+    end of each interval the statistics are either sent on as embedded
+    metric format events with one metric per statistic, e.g. latency_p99,
+    or put with put_metric_data as statistic sets and percentile metrics.
+    Lines that produced a value are dropped unless keep_lines is set, other
+    lines are passed on as is"""
+
+    def __init__(
+        self,
+        next_stage,
+        fields,
+        dimensions=None,
+        namespace=METRIC_NAMESPACE,
+        interval=METRIC_INTERVAL,
+        percentiles=METRIC_PERCENTILES,
+        output=METRIC_OUTPUT_EMF,
+        keep_lines=False,
+    ):
+        LogStage.__init__(self, next_stage)
+        self.fields = [(field, field.split(".")) for field in fields]
+        self.dimensions = [
+            (dimension, dimension.split(".")) for dimension in dimensions or []
+        ]
+        self.namespace = namespace
+        self.interval = interval
+        self.percentiles = percentiles
+        self.output = output
+        self.keep_lines = keep_lines
+        self._lock = Lock()
+        self._aggregates = {}
+        self._interval_start = None
+        self._position = None
+
+    def send(self, line, timestamp=None):
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", "replace")
+        values = self._values(line)
+        if values:
+            key, fields = values
+            with self._lock:
+                now = time.time()
+                if self._interval_start is None:
+                    self._interval_start = now - now % self.interval
+                    self.wake()
+                aggregates = self._aggregates.setdefault(key, {})
+                for field, value in fields:
+                    if field not in aggregates:
+                        aggregates[field] = MetricAggregate()
+                    aggregates[field].add(value)
+            if not self.keep_lines:
+                return
+        self.next_stage.send(line, timestamp=timestamp)
+
+    def _values(self, line):
+        # Cheap check before handing the line to the json parser
+        if not line.lstrip().startswith("{"):
+            return None
         try:
-            self._send_lock.acquire()
-            self._put_log_events(events)
-        except:
-            self.token = None
-            for event in events:
-                self.send(event["message"].encode("utf-8", "replace"))
-        finally:
-            self._send_lock.release()
+            document = json.loads(line)
+        except ValueError:
+            return None
+        fields = []
+        for field, path in self.fields:
+            value = _lookup(document, path)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                fields.append((field, value))
+        if not fields:
+            return None
+        key = tuple(str(_lookup(document, path)) for _, path in self.dimensions)
+        return key, fields
+
+    def mark(self, position):
+        with self._lock:
+            if self._aggregates:
+                # Lines in the aggregates precede the position, so hold on to
+                # it until they have been emitted
+                self._position = position
+            else:
+                self._outgoing.append((None, None, position))
+        self._pass_on()
 
-    @retry(tries=5, delay=1, backoff=2)
-    def _put_log_events(self, events):
-        if not self.token:
-            stream_desc = logs().describe_log_streams(
-                logGroupName=self.group_name, logStreamNamePrefix=self.stream_name
+    def tick(self):
+        # The flushing thread must not wait for the reading thread
+        return self._emit(block=False)
+
+    def close(self):
+        self._emit(force=True)
+
+    def _emit(self, force=False, block=True):
+        put = None
+        with self._lock:
+            if self._interval_start is None:
+                due = None
+            elif time.time() < self._interval_start + self.interval and not force:
+                due = self._interval_start + self.interval
+            else:
+                due = None
+                aggregates = self._aggregates
+                timestamp = int((self._interval_start + self.interval) * 1000)
+                self._aggregates = {}
+                self._interval_start = None
+                if self.output == METRIC_OUTPUT_EMF:
+                    for key, fields in aggregates.items():
+                        self._outgoing.append(
+                            (
+                                json.dumps(self._emf_event(key, fields, timestamp)),
+                                timestamp,
+                                None,
+                            )
+                        )
+                else:
+                    put = aggregates, timestamp
+                if self._position is not None:
+                    self._outgoing.append((None, None, self._position))
+                    self._position = None
+        if put:
+            if self.scheduler and not force:
+                # Puts on the flushing thread would hold up every sender
+                self.scheduler.submit(self._put_metric_data, *put)
+            else:
+                self._put_metric_data(*put)
+        self._pass_on(block=block)
+        return due
+
+    def _statistics(self, field, aggregate):
+        statistics = [
+            (field + "_count", aggregate.count),
+            (field + "_sum", aggregate.sum),
+            (field + "_min", aggregate.min),
+            (field + "_max", aggregate.max),
+        ]
+        for percent in self.percentiles:
+            statistics.append(
+                (field + "_p" + ("%g" % percent), aggregate.percentile(percent))
             )
-            if "uploadSequenceToken" in stream_desc["logStreams"][0]:
-                self.token = stream_desc["logStreams"][0]["uploadSequenceToken"]
-        if self.token:
-            log_response = logs().put_log_events(
-                logGroupName=self.group_name,
-                logStreamName=self.stream_name,
-                logEvents=events,
-                sequenceToken=self.token,
+        return statistics
+
+    def _emf_event(self, key, fields, timestamp):
+        event = {
+            "_aws": {
+                "Timestamp": timestamp,
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": self.namespace,
+                        "Dimensions": [[name for name, _ in self.dimensions]],
+                        "Metrics": [],
+                    }
+                ],
+            }
+        }
+        metrics = event["_aws"]["CloudWatchMetrics"][0]["Metrics"]
+        for (name, _), value in zip(self.dimensions, key):
+            event[name] = value
+        for field, aggregate in fields.items():
+            for name, value in self._statistics(field, aggregate):
+                metrics.append({"Name": name})
+                event[name] = value
+        return event
+
+    def _put_metric_data(self, aggregates, timestamp):
+        when = datetime.fromtimestamp(timestamp / 1000.0, tzutc())
+        metric_data = []
+        for key, fields in aggregates.items():
+            dimensions = [
+                {"Name": name, "Value": value}
+                for (name, _), value in zip(self.dimensions, key)
+            ]
+            for field, aggregate in fields.items():
+                metric_data.append(
+                    {
+                        "MetricName": field,
+                        "Dimensions": dimensions,
+                        "Timestamp": when,
+                        "StatisticValues": {
+                            "SampleCount": aggregate.count,
+                            "Sum": aggregate.sum,
+                            "Minimum": aggregate.min,
+                            "Maximum": aggregate.max,
+                        },
+                    }
+                )
+                for percent in self.percentiles:
+                    metric_data.append(
+                        {
+                            "MetricName": field + "_p" + ("%g" % percent),
+                            "Dimensions": dimensions,
+                            "Timestamp": when,
+                            "Value": aggregate.percentile(percent),
+                        }
+                    )
+        for start in range(0, len(metric_data), METRIC_DATUMS):
+            try:
+                cloudwatch().put_metric_data(
+                    Namespace=self.namespace,
+                    MetricData=metric_data[start : start + METRIC_DATUMS],
+                )
+            except BaseException as err:
+                sys.stderr.write("Failed to put metric data: " + str(err) + "\n")
+
+
+def _lookup(document, path):
+    for name in path:
+        if not isinstance(document, dict):
+            return None
+        document = document.get(name)
+    return document
+
+
+class _PatternSet(object):
+    """Regular expressions searched for as one alternation or, if they use
+    inline flags or backreferences or do not compile together, one at a
+    time. Named alternatives are called p0, p1... so that the one that
+    matched is found with lastgroup. A set of no patterns is false"""
+
+    def __init__(self, patterns, named=False):
+        patterns = patterns or []
+        self.patterns = [re.compile(pattern) for pattern in patterns]
+        self.named = named
+        self.combined = None
+        if patterns and not any(
+            UNCOMBINABLE_PATTERN.search(pattern) for pattern in patterns
+        ):
+            if named:
+                alternatives = [
+                    "(?P<p" + str(index) + ">" + pattern + ")"
+                    for index, pattern in enumerate(patterns)
+                ]
+            else:
+                alternatives = ["(?:" + pattern + ")" for pattern in patterns]
+            try:
+                self.combined = re.compile("|".join(alternatives))
+            except re.error:
+                pass
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    def search(self, line):
+        """Returns whether any of the patterns matches"""
+        if self.combined is not None:
+            return self.combined.search(line) is not None
+        return any(pattern.search(line) for pattern in self.patterns)
+
+    def index(self, line):
+        """Returns the index of the pattern that matched or None. Only for
+        named sets"""
+        if self.combined is not None:
+            match = self.combined.search(line)
+            return int(match.lastgroup[1:]) if match else None
+        for index, pattern in enumerate(self.patterns):
+            if pattern.search(line):
+                return index
+        return None
+
+
+class LogShipper(object):
+    """Ships files given as paths or glob patterns each to its own log stream
+    from a single process. New files matching the patterns are picked up as
+    they appear. stdin and named pipes are read as streams. All streams are
+    flushed by one FlushScheduler on a shared pool of send workers"""
+
+    def __init__(
+        self,
+        file_patterns,
+        group=None,
+        stream=None,
+        checkpoint_dir=CHECKPOINT_DIR,
+        workers=SEND_WORKERS,
+        stages=None,
+        flush_interval=FLUSH_INTERVAL,
+        max_latency=MAX_LATENCY,
+        compression=COMPRESSION_NONE,
+        stats_port=None,
+        stats_socket=None,
+        datagram=False,
+        shards=1,
+        sender_args=None,
+    ):
+        self.file_patterns = file_patterns
+        self.group = group
+        self.stream = stream
+        self.checkpoint_dir = checkpoint_dir
+        self.stages = stages or []
+        self.sender_args = sender_args or {}
+        self.datagram = datagram
+        self.shards = shards
+        self._senders = []
+        self._stages = []
+        self._followers = []
+        self._followed = set()
+        # Followers of files, senders and stages by file name
+        self._files = {}
+        # Followers of files read by follow
+        self._following = []
+        # Files that have been followed by inode, and the latest per file name
+        self._inodes = set()
+        self._open_inodes = {}
+        # Let every shard of a stream have a put in flight
+        workers = max(workers, shards)
+        self._scheduler = FlushScheduler(
+            flush_interval=flush_interval, max_latency=max_latency, workers=workers
+        )
+        self.transport = LogTransport(compression=compression, pool_size=workers)
+        self._stats_servers = []
+        if stats_port:
+            self._stats_servers.append(StatsServer(self.stats, port=stats_port))
+        if stats_socket:
+            self._stats_servers.append(StatsServer(self.stats, path=stats_socket))
+
+    def discover(self):
+        """Returns followers for files matching the patterns that are not yet
+        followed. Files that have been followed under another name, such as
+        rotated files renamed to match a pattern, are skipped. Files matched
+        by a glob that have been deleted stop being followed once everything
+        read from them has been sent"""
+        self._retire()
+        followers = []
+        present = set(self._open_inodes.values())
+        for pattern in self.file_patterns:
+            if GLOB_MAGIC.search(pattern):
+                file_names = sorted(glob.glob(pattern))
+            else:
+                # Literal paths are followed even before they exist
+                file_names = [pattern]
+            for file_name in file_names:
+                try:
+                    file_stat = os.stat(file_name)
+                except OSError:
+                    file_stat = None
+                else:
+                    present.add((file_stat.st_dev, file_stat.st_ino))
+                if (
+                    file_name in self._followed
+                    or (
+                        file_stat
+                        and (file_stat.st_dev, file_stat.st_ino) in self._inodes
+                    )
+                    or os.path.isdir(file_name)
+                    or self._is_stream(file_name)
+                ):
+                    continue
+                self._followed.add(file_name)
+                followers.append(self._follower(file_name))
+        # Forget files that are gone, their inodes may be reused
+        self._inodes &= present
+        return followers
+
+    def _retire(self):
+        for file_name, (follower, log_senders, stages) in list(self._files.items()):
+            if file_name in self.file_patterns or not follower.gone():
+                continue
+            for stage in stages:
+                stage.close()
+            if not all(log_sender.idle() for log_sender in log_senders):
+                continue
+            del self._files[file_name]
+            self._followed.discard(file_name)
+            self._open_inodes.pop(file_name, None)
+            self._followers.remove(follower)
+            if follower in self._following:
+                self._following.remove(follower)
+            for stage in stages:
+                self._stages.remove(stage)
+                self._scheduler.remove_stage(stage)
+            for log_sender in log_senders:
+                if log_sender.checkpoint:
+                    log_sender.checkpoint.flush()
+                self._senders.remove(log_sender)
+                self._scheduler.remove_sender(log_sender)
+
+    def _opened(self, file_name, file_stat):
+        key = (file_stat.st_dev, file_stat.st_ino)
+        self._inodes.add(key)
+        self._open_inodes[file_name] = key
+
+    def _is_stream(self, pattern):
+        if self.datagram or pattern == STDIN:
+            return True
+        try:
+            return stat.S_ISFIFO(os.stat(pattern).st_mode)
+        except OSError:
+            return False
+
+    def _follower(self, file_name):
+        head, position, log_senders, stages = self._chain(
+            file_name, self.checkpoint_dir
+        )
+        follower = FileFollower(
+            file_name,
+            head.send,
+            position=position,
+            position_function=head.mark if self.checkpoint_dir else None,
+            open_function=partial(self._opened, file_name),
+        )
+        self._followers.append(follower)
+        self._files[file_name] = (follower, log_senders, stages)
+        return follower
+
+    def _stream_follower(self, source):
+        # There is nothing to resume in a stream, so no checkpoint
+        head, _, _, _ = self._chain("stdin" if source == STDIN else source, None)
+        follower = StreamFollower(source, head.send, datagram=self.datagram)
+        self._followers.append(follower)
+        return follower
+
+    def _chain(self, file_name, checkpoint_dir):
+        """Returns the first stage and the position to resume from for
+        shipping file_name, and the senders and stages created for it"""
+        stream_name = self.stream or default_stream_name(file_name)
+        if self.shards > 1:
+            stream_names = [
+                stream_name + "|" + str(index) for index in range(self.shards)
+            ]
+        else:
+            stream_names = [stream_name]
+        log_senders = [
+            LogSender(
+                file_name,
+                group=self.group,
+                stream=shard_stream_name,
+                start_thread=False,
+                transport=self.transport,
+                **self.sender_args
             )
+            for shard_stream_name in stream_names
+        ]
+        checkpoint = None
+        position = None
+        if checkpoint_dir:
+            checkpoint = Checkpoint.for_stream(
+                checkpoint_dir, file_name, log_senders[0].group_name, stream_name
+            )
+            position = checkpoint.load()
+        for log_sender in log_senders:
+            self._senders.append(log_sender)
+            self._scheduler.add_sender(log_sender)
+        if len(log_senders) > 1:
+            head = ShardedSender(log_senders, checkpoint=checkpoint)
         else:
-            log_response = logs().put_log_events(
-                logGroupName=self.group_name,
-                logStreamName=self.stream_name,
-                logEvents=events,
+            head = log_senders[0]
+            head.checkpoint = checkpoint
+        stages = []
+        for stage in reversed(self.stages):
+            head = stage(head)
+            self._scheduler.add_stage(head)
+            stages.append(head)
+        self._stages.extend(stages)
+        return head, position, log_senders, stages
+
+    def stats(self):
+        """Prometheus text exposition of the shipper's own metrics"""
+        samples = []
+        for follower in list(self._followers):
+            samples.extend(follower.stats())
+        for log_sender in list(self._senders):
+            samples.extend(log_sender.stats())
+        transport_stats = self.transport.stats()
+        samples.extend(
+            [
+                ("requests_total", {}, transport_stats["requests"]),
+                ("request_raw_bytes_total", {}, transport_stats["rawBytes"]),
+                ("request_wire_bytes_total", {}, transport_stats["wireBytes"]),
+            ]
+        )
+        return render_prometheus(samples)
+
+    def run(self):
+        self._following = self.discover()
+        streams = [
+            self._stream_follower(pattern)
+            for pattern in self.file_patterns
+            if self._is_stream(pattern)
+        ]
+        self._scheduler.start()
+        for stats_server in self._stats_servers:
+            stats_server.start()
+        threads = []
+        for stream in streams:
+            thread = Thread(target=stream.run)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        try:
+            if len(streams) < len(self.file_patterns):
+                follow(self._following, discover=self.discover)
+            else:
+                # Only streams: ship until they have all ended
+                for thread in threads:
+                    while thread.is_alive():
+                        thread.join(1)
+                for stage in self._stages:
+                    stage.close()
+                for log_sender in self._senders:
+                    log_sender.flush()
+        finally:
+            for stream in streams:
+                stream.stop()
+            for stats_server in self._stats_servers:
+                stats_server.stop()
+            self._scheduler.stop()
+            for log_sender in self._senders:
+                if log_sender.checkpoint:
+                    log_sender.checkpoint.flush()
+
+
+def render_prometheus(samples):
+    """Render (name, labels, value) samples in the Prometheus text format.
+    Names get STATS_PREFIX and samples of the same metric are grouped"""
+    by_name = {}
+    for name, labels, value in samples:
+        by_name.setdefault(name, []).append((labels, value))
+    lines = []
+    for name in sorted(by_name):
+        for labels, value in by_name[name]:
+            label_text = ",".join(
+                key + '="' + str(label).replace("\\", "\\\\").replace('"', '\\"') + '"'
+                for key, label in sorted(labels.items())
             )
-        if "CLOUDWATCH_LOG_DEBUG" in os.environ:
-            print("Sent " + str(len(events)) + " messages to " + self.stream_name)
-        if log_response and "nextSequenceToken" in log_response:
-            self.token = log_response["nextSequenceToken"]
+            lines.append(
+                STATS_PREFIX
+                + name
+                + ("{" + label_text + "}" if label_text else "")
+                + " "
+                + str(value)
+            )
+    return "\n".join(lines) + "\n"
+
+
+class _StatsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.stats_function().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _TCPStatsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _UnixStatsServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # BaseHTTPRequestHandler expects a client address tuple
+        request, _ = self.socket.accept()
+        return request, ("", 0)
+
+
+class StatsServer(Thread):
+    """Serves the text from stats_function over HTTP on localhost:port or on
+    a unix socket at path, e.g. for curl --unix-socket"""
+
+    def __init__(self, stats_function, port=None, path=None):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        if path:
+            if os.path.exists(path):
+                os.remove(path)
+            self.server = _UnixStatsServer(path, _StatsHandler)
         else:
-            self.token = None
+            self.server = _TCPStatsServer(("127.0.0.1", port), _StatsHandler)
+        self.server.stats_function = stats_function
+        self.path = path
 
+    def run(self):
+        self.server.serve_forever()
 
-def send_log_to_cloudwatch(file_name, group=None, stream=None):
-    log_sender = LogSender(file_name, group=group, stream=stream)
-    read_and_follow(file_name, log_sender.send)
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def send_log_to_cloudwatch(
+    file_name,
+    group=None,
+    stream=None,
+    checkpoint_dir=CHECKPOINT_DIR,
+    stages=None,
+    flush_interval=FLUSH_INTERVAL,
+    max_latency=MAX_LATENCY,
+    compression=COMPRESSION_NONE,
+    stats_port=None,
+    stats_socket=None,
+    datagram=False,
+    shards=1,
+    **sender_args
+):
+    send_logs_to_cloudwatch(
+        [file_name],
+        group=group,
+        stream=stream,
+        checkpoint_dir=checkpoint_dir,
+        stages=stages,
+        flush_interval=flush_interval,
+        max_latency=max_latency,
+        compression=compression,
+        stats_port=stats_port,
+        stats_socket=stats_socket,
+        datagram=datagram,
+        shards=shards,
+        **sender_args
+    )
+
+
+def send_logs_to_cloudwatch(
+    file_patterns,
+    group=None,
+    stream=None,
+    checkpoint_dir=CHECKPOINT_DIR,
+    stages=None,
+    flush_interval=FLUSH_INTERVAL,
+    max_latency=MAX_LATENCY,
+    compression=COMPRESSION_NONE,
+    stats_port=None,
+    stats_socket=None,
+    datagram=False,
+    shards=1,
+    **sender_args
+):
+    """Ship files matching file_patterns to CloudWatch. "-" reads stdin and
+    named pipes are read as streams, as are all paths if datagram is set.
+    stages is a list of callables that create a LogStage given the next
+    stage, applied to lines in order. Extra keyword arguments are passed on
+    to each LogSender"""
+    LogShipper(
+        file_patterns,
+        group=group,
+        stream=stream,
+        checkpoint_dir=checkpoint_dir,
+        stages=stages,
+        flush_interval=flush_interval,
+        max_latency=max_latency,
+        compression=compression,
+        stats_port=stats_port,
+        stats_socket=stats_socket,
+        datagram=datagram,
+        shards=shards,
+        sender_args=sender_args,
+    ).run()
 
 
 @retry(tries=10, delay=1, backoff=3)
@@ -330,6 +2405,10 @@ def resolve_stack_name():
     return stack_name
 
 
+def default_stream_name(file_name):
+    return resolve_instance_id() + "|" + file_name.replace(":", "_").replace("*", "_")
+
+
 @retry(tries=10, delay=1, backoff=3)
 def resolve_instance_id():
     instance_id = info().instance_id()
@@ -339,33 +2418,532 @@ def resolve_instance_id():
     return instance_id
 
 
-def read_and_follow(file_name, line_function, wait=1):
-    while not (os.path.isfile(file_name) and os.path.exists(file_name)):
-        time.sleep(wait)
-    with open(file_name) as file_:
-        end_seen = False
+class Inotify(object):
+    """Minimal ctypes binding to Linux inotify. Only used to wake up file
+    followers, so events are drained and discarded rather than parsed."""
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._watches = {}
+
+    def add_watch(self, path, mask=FOLLOW_EVENTS):
+        if path in self._watches:
+            return self._watches[path]
+        wd = self._libc.inotify_add_watch(self.fd, path.encode("utf-8"), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed: " + path)
+        self._watches[path] = wd
+        return wd
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except OSError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+def inotify():
+    """Return an Inotify instance or None if not available on this platform"""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        return Inotify()
+    except (OSError, AttributeError):
+        return None
+
+
+class FileFollower(object):
+    """Follows a single file, reading appended data in large chunks and
+    handing complete lines to a line function. Rotation by rename or
+    re-create is detected by comparing the inode of the open file to the file
+    currently at the path. Truncation (copytruncate) is detected by the file
+    shrinking below the read offset or its first bytes changing, since under
+    constant writes it may have grown past the offset again, or before any
+    of it was read by a new copy appearing among the siblings; the rest of
+    the file is then read from the copy if there is one among the siblings.
+    Files that were rotated away before we got to open them are found among
+    the uncompressed siblings of the file by inode and read in mtime order.
+
+    If position is given as an (inode, offset) tuple, reading resumes from
+    there, also when the file has been rotated in between. position_function
+    is called with the (inode, offset) of the end of the last line handed
+    to the line function after each chunk and open_function with the stat
+    of each file opened at the path"""
+
+    def __init__(
+        self,
+        file_name,
+        line_function,
+        chunk_size=READ_CHUNK,
+        position=None,
+        position_function=None,
+        open_function=None,
+    ):
+        self.file_name = file_name
+        self.line_function = line_function
+        self.chunk_size = chunk_size
+        self.position = position
+        self.position_function = position_function
+        self.open_function = open_function
+        self._file = None
+        self._inode = None
+        self._pending = b""
+        self._head = b""
+        self._started = False
+        self._seen = set()
+        self.lines_read = 0
+        self.bytes_read = 0
+        self.offset = 0
+
+    def open(self):
+        if not os.path.isfile(self.file_name):
+            return False
+        self._file = open(self.file_name, "rb", buffering=0)
+        file_stat = os.fstat(self._file.fileno())
+        self._inode = file_stat.st_ino
+        self.offset = 0
+        self._head = b""
+        self._mark_seen(file_stat)
+        if self.open_function:
+            self.open_function(file_stat)
+        return True
+
+    def gone(self):
+        """True once the file has been deleted and is no longer open"""
+        return not self._file and not os.path.exists(self.file_name)
+
+    def watch_path(self):
+        return os.path.dirname(os.path.abspath(self.file_name))
+
+    def read_available(self):
+        """Read everything appended since the last call. Returns True if any
+        data was read"""
+        if not self._file:
+            if not self.open():
+                return False
+            if not self._started:
+                self._start()
+        # Must be checked before reading, the old offset may be in the middle
+        # of new data
+        truncated = self._check_truncated()
+        if truncated:
+            self._head = self._read_copy()
+            self._file.seek(0)
+            self.offset = 0
+        read_any = self._drain(self._file, self._inode) or truncated
+        if self._check_rotated():
+            # Pick up anything written to the old file before it was rotated
+            self._drain(self._file, self._inode)
+            self._flush_pending()
+            self._file.close()
+            self._file = None
+            # Open the new file first so that every file rotated before it is
+            # visible to the sibling scan
+            self.open()
+            for sibling, sibling_stat in self._unseen_siblings():
+                self._read_rotated(sibling, sibling_stat)
+            if self._file:
+                self._drain(self._file, self._inode)
+            return True
+        return read_any
+
+    def _start(self):
+        self._started = True
+        siblings = sorted(self._siblings(), key=lambda sibling: sibling[1].st_mtime)
+        # Anything rotated before we started is not ours to ship unless we are
+        # resuming from a position in one of those files
+        for _, sibling_stat in siblings:
+            self._mark_seen(sibling_stat)
+        if not self.position:
+            return
+        inode, offset = self.position
+        if inode == self._inode:
+            if os.fstat(self._file.fileno()).st_size >= offset:
+                self._file.seek(offset)
+                self.offset = offset
+            return
+        for index, (sibling, sibling_stat) in enumerate(siblings):
+            if sibling_stat.st_ino == inode:
+                self._read_rotated(sibling, sibling_stat, offset)
+                for newer, newer_stat in siblings[index + 1 :]:
+                    self._read_rotated(newer, newer_stat)
+                return
+
+    def _read_rotated(self, file_name, file_stat, offset=0):
+        self._mark_seen(file_stat)
+        try:
+            with open(file_name, "rb", buffering=0) as rotated:
+                if offset <= file_stat.st_size:
+                    rotated.seek(offset)
+                self._drain(rotated, file_stat.st_ino)
+        except (IOError, OSError):
+            pass
+        self._flush_pending()
+
+    def _drain(self, file_, inode):
+        read_any = False
         while True:
-            curr_position = file_.tell()
-            line = file_.readline()
-            if not line:
-                file_.seek(curr_position)
-                end_seen = True
+            data = file_.read(self.chunk_size)
+            if not data:
+                return read_any
+            read_any = True
+            if inode == self._inode and self._check_truncated():
+                # Truncated while reading, the data may be from after it. It is
+                # read from the copy on the next call instead
+                file_.seek(-len(data), os.SEEK_CUR)
+                return read_any
+            self.bytes_read += len(data)
+            self._emit(self._pending + data if self._pending else data)
+            offset = file_.tell() - len(self._pending)
+            if inode == self._inode:
+                self.offset = offset
+                self._update_head(data, file_.tell() - len(data))
+            if self.position_function:
+                self.position_function((inode, offset))
+
+    def stats(self):
+        """Prometheus samples of this follower as (name, labels, value)
+        tuples"""
+        labels = {"file": self.file_name}
+        try:
+            path_stat = os.stat(self.file_name)
+        except OSError:
+            size = lag = 0
+        else:
+            size = path_stat.st_size
+            # Not yet noticed rotation means the whole new file is unread
+            lag = size - self.offset if path_stat.st_ino == self._inode else size
+        return [
+            ("lines_read_total", labels, self.lines_read),
+            ("bytes_read_total", labels, self.bytes_read),
+            ("read_offset_bytes", labels, self.offset),
+            ("file_size_bytes", labels, size),
+            ("read_lag_bytes", labels, max(0, lag)),
+        ]
+
+    def _check_rotated(self):
+        try:
+            path_stat = os.stat(self.file_name)
+        except OSError:
+            # Moved or deleted and not yet re-created; keep the old file open
+            # unless it is gone for good
+            if os.fstat(self._file.fileno()).st_nlink == 0:
+                self._flush_pending()
+                self._file.close()
+                self._file = None
+            return False
+        open_stat = os.fstat(self._file.fileno())
+        return (path_stat.st_ino, path_stat.st_dev) != (
+            open_stat.st_ino,
+            open_stat.st_dev,
+        )
+
+    def _check_truncated(self):
+        fileno = self._file.fileno()
+        size = os.fstat(fileno).st_size
+        if size < self._file.tell():
+            return True
+        if not self._head:
+            # Nothing read to compare with, but a copy of other data made since
+            # means the file was truncated before we got to read it
+            return size > 0 and self.offset == 0 and self._copied()
+        return os.pread(fileno, len(self._head), 0) != self._head
+
+    def _copied(self):
+        current = os.pread(self._file.fileno(), HEAD_FINGERPRINT_BYTES, 0)
+        for sibling, sibling_stat in self._siblings():
+            if (sibling_stat.st_dev, sibling_stat.st_ino) in self._seen:
+                continue
+            head = self._file_head(sibling, HEAD_FINGERPRINT_BYTES)
+            if head and head[: len(current)] != current[: len(head)]:
+                return True
+        return False
+
+    def _read_copy(self):
+        """Read what was left unread before truncation from the copy of the
+        file, recognized by its first bytes. Copies made after it, if the
+        file was copied and truncated again meanwhile, are read whole in
+        mtime order, except for a copy of what the file now holds. Returns
+        the first bytes the file now holds, so that a further truncation
+        before it is read is noticed and that copy read instead"""
+        offset = self._file.tell()
+        current = os.pread(self._file.fileno(), HEAD_FINGERPRINT_BYTES, 0)
+        copies = sorted(
+            (sibling_stat.st_mtime, sibling, sibling_stat)
+            for sibling, sibling_stat in self._siblings()
+            if (sibling_stat.st_dev, sibling_stat.st_ino) not in self._seen
+        )
+        for index, (_, sibling, sibling_stat) in enumerate(copies):
+            # Without a fingerprint nothing was read, the oldest copy is it
+            if (
+                sibling_stat.st_size >= offset
+                and self._file_head(sibling, len(self._head)) == self._head
+            ):
+                self._read_rotated(sibling, sibling_stat, offset)
+                for _, newer, newer_stat in copies[index + 1 :]:
+                    head = self._file_head(newer, HEAD_FINGERPRINT_BYTES)
+                    if head is None or (
+                        current and head[: len(current)] == current[: len(head)]
+                    ):
+                        continue
+                    self._read_rotated(newer, newer_stat)
+                return current
+        self._flush_pending()
+        return current
+
+    def _file_head(self, file_name, length):
+        try:
+            with open(file_name, "rb") as file_:
+                return file_.read(length)
+        except (IOError, OSError):
+            return None
+
+    def _update_head(self, data, start):
+        """Extend the fingerprint with data read from start. Reading the file
+        again could see it after truncation"""
+        length = len(self._head)
+        if length >= HEAD_FINGERPRINT_BYTES:
+            return
+        if start <= length:
+            self._head = (self._head[:start] + data)[:HEAD_FINGERPRINT_BYTES]
+        else:
+            # Resumed from the middle of the file
+            self._head = os.pread(
+                self._file.fileno(), min(HEAD_FINGERPRINT_BYTES, start + len(data)), 0
+            )
+
+    def _flush_pending(self):
+        if self._pending:
+            pending = self._pending
+            self._pending = b""
+            self.line_function(pending.decode("utf-8", "replace") + "\n")
+
+    def _mark_seen(self, file_stat):
+        self._seen.add((file_stat.st_dev, file_stat.st_ino))
+
+    def _siblings(self):
+        directory, base = os.path.split(os.path.abspath(self.file_name))
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return
+        for name in names:
+            if (
+                name == base
+                or not name.startswith(base)
+                or name.endswith(COMPRESSED_SUFFIXES)
+            ):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                sibling_stat = os.stat(path)
+            except OSError:
+                continue
+            if stat.S_ISREG(sibling_stat.st_mode):
+                yield path, sibling_stat
+
+    def _unseen_siblings(self):
+        siblings = list(self._siblings())
+        unseen = [
+            (sibling_stat.st_mtime, path, sibling_stat)
+            for path, sibling_stat in siblings
+            if (sibling_stat.st_dev, sibling_stat.st_ino) not in self._seen
+        ]
+        # Forget inodes that are no longer around so that reused inode numbers
+        # do not hide new rotated files
+        self._seen = set(
+            (sibling_stat.st_dev, sibling_stat.st_ino) for _, sibling_stat in siblings
+        )
+        if self._file:
+            self._mark_seen(os.fstat(self._file.fileno()))
+        return [(path, sibling_stat) for _, path, sibling_stat in sorted(unseen)]
+
+    def _emit(self, data):
+        end = data.rfind(b"\n")
+        if end < 0:
+            if len(data) < MAX_LINE:
+                self._pending = data
             else:
-                line_function(line)
-                end_seen = False
-            if end_seen:
-                time.sleep(wait)
+                self._pending = b""
+                self.line_function(data.decode("utf-8", "replace"))
+            return
+        self._pending = data[end + 1 :]
+        line_function = self.line_function
+        lines = data[:end].decode("utf-8", "replace").split("\n")
+        self.lines_read += len(lines)
+        for line in lines:
+            line_function(line + "\n")
+
+
+class StreamFollower(FileFollower):
+    """Reads lines from stdin, a named pipe or, if datagram is set, from a
+    unix datagram socket bound at file_name, e.g. for syslog. Each read
+    waits for data and then takes up to chunk_size bytes at once. A named
+    pipe is opened again when its last writer closes it, stdin ends at end
+    of file. Each datagram is one line"""
+
+    def __init__(self, file_name, line_function, datagram=False, chunk_size=READ_CHUNK):
+        FileFollower.__init__(self, file_name, line_function, chunk_size=chunk_size)
+        self.datagram = datagram
+        self._stopped = Event()
 
+    def stop(self):
+        self._stopped.set()
 
-class AtomicInteger:
-    def __init__(self, value=0):
-        self._value = int(value)
-        self._lock = Lock()
+    def run(self):
+        if self.datagram:
+            self._read_datagrams()
+        else:
+            self._read_stream()
 
-    def inc(self, d=1):
-        with self._lock:
-            self._value += int(d)
-            return self._value
+    def _read_stream(self):
+        while not self._stopped.is_set():
+            if self.file_name == STDIN:
+                fd = sys.stdin.fileno()
+            else:
+                # Blocks until a writer opens the pipe
+                fd = os.open(self.file_name, os.O_RDONLY)
+            try:
+                while not self._stopped.is_set():
+                    readable, _, _ = select.select([fd], [], [], 1)
+                    if not readable:
+                        continue
+                    data = os.read(fd, self.chunk_size)
+                    if not data:
+                        break
+                    self.bytes_read += len(data)
+                    self._emit(self._pending + data if self._pending else data)
+            finally:
+                self._flush_pending()
+                if self.file_name != STDIN:
+                    os.close(fd)
+            if self.file_name == STDIN:
+                return
+
+    def _read_datagrams(self):
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
+        datagram_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        datagram_socket.bind(self.file_name)
+        datagram_socket.settimeout(1)
+        try:
+            while not self._stopped.is_set():
+                try:
+                    data = datagram_socket.recv(MAX_LINE)
+                except socket.timeout:
+                    continue
+                self.bytes_read += len(data)
+                self.lines_read += 1
+                self.line_function(data.decode("utf-8", "replace").rstrip("\n") + "\n")
+        finally:
+            datagram_socket.close()
+            os.remove(self.file_name)
+
+    def stats(self):
+        labels = {"file": self.file_name}
+        return [
+            ("lines_read_total", labels, self.lines_read),
+            ("bytes_read_total", labels, self.bytes_read),
+        ]
+
+
+def follow(followers, wait=1, discover=None):
+    """Keep reading the given followers, sleeping on inotify events if
+    available and polling every wait seconds otherwise. If given, discover
+    is called at most every wait seconds and returns new followers to add"""
+    notify = inotify()
+    last_discover = time.time()
+    try:
+        while True:
+            if discover and time.time() - last_discover >= wait:
+                followers.extend(discover())
+                last_discover = time.time()
+            read_any = False
+            for follower in followers:
+                if notify:
+                    _try_watch(notify, follower.watch_path())
+                if follower.read_available():
+                    read_any = True
+            if not read_any:
+                if notify:
+                    notify.wait(wait)
+                else:
+                    time.sleep(wait)
+    finally:
+        if notify:
+            notify.close()
+
+
+def _try_watch(notify, path):
+    try:
+        notify.add_watch(path)
+    except OSError:
+        pass
+
+
+def read_and_follow(file_name, line_function, wait=1):
+    follow([FileFollower(file_name, line_function)], wait=wait)
+
+
+class RateLimiter(object):
+    """Token bucket for asyncio tasks that allows burst requests at once and
+    rate requests per second on average. The rate adapts AIMD style: each
+    success adds step requests per second spread over a second's worth of
+    requests, up to max_rate, and each throttle multiplies it by backoff,
+    down to min_rate, and empties the bucket. One limiter is shared by all
+    tasks of a query"""
+
+    def __init__(
+        self,
+        rate=FETCH_RATE,
+        burst=FETCH_BURST,
+        min_rate=FETCH_MIN_RATE,
+        max_rate=FETCH_MAX_RATE,
+        step=FETCH_RATE_STEP,
+        backoff=FETCH_BACKOFF,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min(min_rate, rate)
+        self.max_rate = max(max_rate, rate)
+        self.step = step
+        self.backoff = backoff
+        self.throttles = 0
+        self._tokens = burst
+        self._updated = time.time()
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def succeeded(self):
+        self.rate = min(self.max_rate, self.rate + self.step / self.rate)
+
+    def throttled(self):
+        self._refill()
+        self.throttles += 1
+        self.rate = max(self.min_rate, self.rate * self.backoff)
+        self._tokens = min(self._tokens, 0)
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
 
 
 class CloudWatchLogsThread(Thread):
@@ -396,250 +2974,789 @@ class CloudWatchLogsGroups(object):
         end_time=None,
         sort=False,
         short_format=False,
+        concurrency=FETCH_CONCURRENCY,
+        rate=FETCH_RATE,
+        burst=FETCH_BURST,
+        max_rate=FETCH_MAX_RATE,
+        group_cache=None,
+        output=OUTPUT_TEXT,
+        export_dir=None,
+        export_shards=EXPORT_SHARDS,
+        insights=None,
     ):
         self.log_filter = log_filter
         self.log_group_filter = log_group_filter
+        self.group_cache = group_cache
+        self.export_dir = export_dir
+        self.export_shards = export_shards
+        self.insights = insights
+        if export_dir and output == OUTPUT_TEXT:
+            output = OUTPUT_JSONL
+        self.output = output
+        # Colors only for people reading a terminal
+        self.color = output == OUTPUT_TEXT and sys.stdout.isatty()
         self.start_time = validatestarttime(parse_datetime(start_time))
         self.end_time = parse_datetime(end_time) * 1000 if end_time else None
+        self.absolute_range = not (
+            relative_datetime(start_time) or relative_datetime(end_time)
+        )
+        if (export_dir or insights) and not self.end_time:
+            self.end_time = int(time.time() * 1000)
+        self._manifest = None
         self.sort = sort
         self._stopped = Event()
         self.short_format = short_format
-        self.event_counter = AtomicInteger()
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.max_rate = max_rate
+        self.group_mappings = {}
+        self.stream_mappings = {}
+        self._counter = itertools.count()
+        self._first_timestamp = None
+        self._stripper = TimestampStripper()
+        self._initial_pending = 0
+        self._sources = []
+        self._heads = []
+        self._buffered = 0
+        self._discovered = False
 
     def filter_groups(self, log_group_filter, groups):
-        filtered = []
-        for group in groups:
-            if re.search(log_group_filter, group["logGroupName"]):
-                filtered.append(group["logGroupName"])
-        return filtered
+        pattern = re.compile(log_group_filter)
+        return [
+            group["logGroupName"]
+            for group in groups
+            if pattern.search(group["logGroupName"])
+        ]
 
     def get_filtered_groups(self, log_group_filter):
-        resp = logs().describe_log_groups()
         filtered_group_names = []
-        filtered_group_names.extend(
-            self.filter_groups(self.log_group_filter, resp["logGroups"])
-        )
-        while resp.get("nextToken"):
-            resp = logs().describe_log_groups(nextToken=resp["nextToken"])
-            filtered_group_names.extend(
-                self.filter_groups(self.log_group_filter, resp["logGroups"])
-            )
+        for group_names in self.group_pages(log_group_filter):
+            filtered_group_names.extend(group_names)
         return filtered_group_names
 
-    def get_logs(self):
-        groups = self.get_filtered_groups(self.log_group_filter)
-        log_threads = []
-        work_queue = queue.Queue()
-        semaphore = BoundedSemaphore(5)
-        output_queue = queue.PriorityQueue()
-        work_items = []
+    def group_pages(self, log_group_filter):
+        """Yields lists of matching group names a page at a time. Groups are
+        listed with the literal prefix of the filter, if it has one, and
+        taken from the group cache when it has a fresh listing with matches.
+        A listing without matches may predate a new group, so it is refreshed"""
+        pattern = re.compile(log_group_filter)
+        prefix = literal_prefix(log_group_filter)
+        if self.group_cache:
+            cached = self.group_cache.load(prefix)
+            if cached is not None:
+                matches = [name for name in cached if pattern.search(name)]
+                if matches:
+                    yield matches
+                    return
+        args = {"limit": LOG_GROUP_PAGE}
+        if prefix:
+            args["logGroupNamePrefix"] = prefix
+        group_names = []
+        while True:
+            resp = logs().describe_log_groups(**args)
+            page = [group["logGroupName"] for group in resp["logGroups"]]
+            group_names.extend(page)
+            yield [name for name in page if pattern.search(name)]
+            if not resp.get("nextToken"):
+                break
+            args["nextToken"] = resp["nextToken"]
+        if self.group_cache:
+            self.group_cache.save(prefix, group_names)
 
-        for group_name in groups:
-            work_item = {
-                "item": {
-                    "logGroupName": group_name,
-                    "interleaved": True,
-                    "startTime": self.start_time,
-                    "filterPattern": self.log_filter if self.log_filter else "",
-                },
-                "meta": {"initialQueriesDone": Event()},
-            }
-            if self.end_time:
-                work_item["item"]["endTime"] = self.end_time
-            work_queue.put(work_item)
-            work_items.append(work_item)
-
-        for _ in range(10):
-            cwlogs_worker = CloudWatchLogsWorker(
-                work_queue,
-                semaphore,
-                output_queue,
-                self.event_counter,
-                short_format=self.short_format,
+    def get_logs(self):
+        """Print events from matching groups. Pages are fetched by asyncio
+        tasks, one per group, or one per time slice of a bounded and ordered
+        query when there are few groups, with the boto calls run on a thread pool"""
+        loop = asyncio.new_event_loop()
+        main = loop.create_task(self._fetch())
+        try:
+            loop.run_until_complete(main)
+        except KeyboardInterrupt:
+            main.cancel()
+            try:
+                loop.run_until_complete(main)
+            except (asyncio.CancelledError, KeyboardInterrupt):
+                pass
+        finally:
+            loop.close()
+
+    async def _fetch(self):
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        # Throttling is handled by the limiter, so botocore must not hide it
+        # with retries of its own
+        client = Session().client(
+            "logs",
+            region_name=region(),
+            config=Config(
+                max_pool_connections=self.concurrency,
+                retries={"total_max_attempts": 1},
+            ),
+        )
+        limiter = RateLimiter(rate=self.rate, burst=self.burst, max_rate=self.max_rate)
+        if self.insights:
+            try:
+                await self._query(client, executor, limiter)
+            finally:
+                executor.shutdown(wait=False)
+            return
+        tasks = []
+        if self.export_dir:
+            self._manifest = ExportManifest(
+                self.export_dir,
+                self.start_time,
+                self.end_time,
+                self.log_group_filter,
+                self.log_filter,
+                self.export_shards,
+                self.output,
+                self.absolute_range,
             )
-            log_threads.append(cwlogs_worker)
-            cwlogs_worker.start()
-
-        speed_limiter = SpeedLimitThread(semaphore)
-        speed_limiter.start()
-        all_initial_queries_done = False
-        tailing = True if not self.end_time else False
-        wait_time = None if self.sort else 0.0
-
-        while not self._stopped.isSet():
+            # Relative times differ between runs, resume with the original
+            self.start_time = self._manifest.start
+            self.end_time = self._manifest.end
+            self._manifest.set_shard_count(len(self._ranges(self.export_shards)))
+
+        def start(group_names, slices):
+            for group_name in group_names:
+                if self._manifest and self._manifest.exported(group_name):
+                    continue
+                for index, (start, end) in enumerate(slices):
+                    source = MergeSource(group_name, start, end, index)
+                    if self._manifest and self._manifest.shard_done(source):
+                        continue
+                    self._sources.append(source)
+                    self._initial_pending += 1
+                    if self._manifest:
+                        fetch = self._export_shard(source, client, executor, limiter)
+                    else:
+                        fetch = self._fetch_group(source, client, executor, limiter)
+                    tasks.append(loop.create_task(fetch))
+
+        # Start fetching groups as soon as they are found
+        pages = self.group_pages(self.log_group_filter)
+        page = await loop.run_in_executor(executor, next, pages, None)
+        if self._manifest:
+            groups = []
             try:
-                if not all_initial_queries_done:
-                    loop_queries_done = True
-                    for work_item in work_items:
-                        if not work_item["meta"]["initialQueriesDone"].wait(wait_time):
-                            loop_queries_done = False
-                    all_initial_queries_done = loop_queries_done
-                elif self.sort:
-                    time.sleep(5.0)  # allow time to sort while tailing
-                self.print_output_if_any(output_queue)
-                if all_initial_queries_done and not tailing:
-                    raise KeyboardInterrupt
-            except KeyboardInterrupt:
-                for thread in log_threads:
-                    thread.stop()
-                speed_limiter.stop()
-                return
-
-    def print_output_if_any(self, output_queue):
+                while page is not None:
+                    groups.extend(page)
+                    start(page, self._ranges(self.export_shards))
+                    page = await loop.run_in_executor(executor, next, pages, None)
+                self._discovered = True
+                await asyncio.gather(*tasks)
+                self._concatenate(groups)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                executor.shutdown(wait=False)
+            return
+        next_page = await loop.run_in_executor(executor, next, pages, None)
+        if next_page is None and self.sort:
+            # Ordered queries over a single page of groups can be sliced, the
+            # merge puts the slices back in order
+            start(page or [], self._slices(len(page or [])))
+        else:
+            single = [(self.start_time, self.end_time)]
+            start(page or [], single)
+            while next_page is not None:
+                start(next_page, single)
+                next_page = await loop.run_in_executor(executor, next, pages, None)
+        self._discovered = True
+        tailing = not self.end_time
+        try:
+            while not self._stopped.is_set():
+                if self.sort:
+                    self._merge()
+                if self.output != OUTPUT_TEXT:
+                    sys.stdout.flush()
+                if self._initial_pending == 0 and not tailing:
+                    return
+                await asyncio.sleep(MERGE_INTERVAL)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            executor.shutdown(wait=False)
+
+    def _slices(self, group_count):
+        """Time ranges to fetch in parallel for each group. Only bounded
+        and ordered queries over few groups are split"""
+        if not self.end_time:
+            return [(self.start_time, None)]
+        count = min(
+            FETCH_SLICES,
+            self.concurrency // max(1, group_count),
+            (self.end_time - self.start_time) // FETCH_MIN_SLICE,
+        )
+        return self._ranges(count)
+
+    def _ranges(self, count):
+        """The bounded query time range split into count parts"""
+        count = max(1, min(count, self.end_time - self.start_time + 1))
+        if count == 1:
+            return [(self.start_time, self.end_time)]
+        step = (self.end_time - self.start_time) // count
+        starts = [self.start_time + index * step for index in range(count)]
+        # End times are inclusive
+        ends = [start - 1 for start in starts[1:]] + [self.end_time]
+        return list(zip(starts, ends))
+
+    async def _fetch_group(self, source, client, executor, limiter):
+        item = {
+            "logGroupName": source.group_name,
+            "interleaved": True,
+            "startTime": source.start,
+            "filterPattern": self.log_filter if self.log_filter else "",
+        }
+        if source.end:
+            item["endTime"] = source.end
+        initial = True
+        last_timestamp = None
+        try:
+            while True:
+                # Sources ahead of the merge wait when the buffers are full
+                while (
+                    self.sort
+                    and self._buffered >= MERGE_MAX_EVENTS
+                    and source.watermark > self._watermark()
+                ):
+                    await asyncio.sleep(MERGE_INTERVAL)
+                requested = int(time.time() * 1000)
+                response = await self._request(
+                    client, executor, limiter, "filter_log_events", dict(item)
+                )
+                events = response.get("events", [])
+                events.sort(key=itemgetter("timestamp"))
+                for event in events:
+                    event["logGroupName"] = source.group_name
+                    last_timestamp = event.get("timestamp", None)
+                    self._output(event, source)
+                if "nextToken" in response:
+                    item["nextToken"] = response["nextToken"]
+                    if last_timestamp:
+                        # Later pages may still have events at the same time
+                        source.advance(last_timestamp - 1)
+                    continue
+                item.pop("nextToken", None)
+                if last_timestamp:
+                    item["startTime"] = last_timestamp + 1
+                last_timestamp = None
+                if initial:
+                    initial = False
+                    self._initial_pending -= 1
+                if source.end:
+                    source.advance(float("inf"))
+                    return True
+                # Everything ingested before the request has been seen
+                source.advance(requested - MERGE_LAG)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            sys.stderr.write(
+                "Failed to get logs from " + source.group_name + ": " + str(err) + "\n"
+            )
+            source.advance(float("inf"))
+            if initial:
+                self._initial_pending -= 1
+        return False
+
+    async def _request(self, client, executor, limiter, operation, args):
+        """Call a client operation on the thread pool at the rate the limiter
+        allows, retrying throttled calls and failures with backoff"""
+        loop = asyncio.get_running_loop()
+        failures = 0
         while True:
+            await limiter.acquire()
             try:
-                uprint(" ".join(output_queue.get(timeout=1.0)[2]))
-            except queue.Empty:
-                break
-
-
-class SpeedLimitThread(Thread):
-    def __init__(self, semaphore):
-        Thread.__init__(self)
-        self.semaphore = semaphore
-        self._stopped = Event()
-        self.setDaemon(True)
+                response = await loop.run_in_executor(
+                    executor, call_client, client, operation, args
+                )
+            except Exception as err:
+                if _throttled(err):
+                    limiter.throttled()
+                    continue
+                failures += 1
+                if failures >= FETCH_TRIES:
+                    raise
+                await asyncio.sleep(FETCH_RETRY_DELAY * 2 ** (failures - 1))
+                continue
+            limiter.succeeded()
+            return response
+
+    async def _query(self, client, executor, limiter):
+        """Run the Logs Insights query over the matching groups in batches of
+        at most INSIGHTS_MAX_GROUPS groups, the most one query takes"""
+        loop = asyncio.get_running_loop()
+        groups = []
+        pages = self.group_pages(self.log_group_filter)
+        page = await loop.run_in_executor(executor, next, pages, None)
+        while page is not None:
+            groups.extend(page)
+            page = await loop.run_in_executor(executor, next, pages, None)
+        running = asyncio.Semaphore(INSIGHTS_CONCURRENCY)
+        await asyncio.gather(
+            *[
+                self._query_batch(
+                    groups[index : index + INSIGHTS_MAX_GROUPS],
+                    client,
+                    executor,
+                    limiter,
+                    running,
+                )
+                for index in range(0, len(groups), INSIGHTS_MAX_GROUPS)
+            ]
+        )
 
-    def tick(self):
-        while not self._stopped.wait(1.1):
+    async def _query_batch(self, groups, client, executor, limiter, running):
+        async with running:
+            response = await self._request(
+                client,
+                executor,
+                limiter,
+                "start_query",
+                {
+                    "logGroupNames": groups,
+                    "startTime": self.start_time // 1000,
+                    "endTime": self.end_time // 1000,
+                    "queryString": self.insights,
+                },
+            )
+            query_id = response["queryId"]
+            status = None
+            delay = INSIGHTS_POLL
             try:
-                for _ in range(5):
-                    self.semaphore.release()
-            except ValueError:
-                pass
-        return
-
-    def stop(self):
-        self._stopped.set()
+                while status not in INSIGHTS_DONE:
+                    await asyncio.sleep(delay)
+                    delay = min(INSIGHTS_MAX_POLL, delay * 2)
+                    response = await self._request(
+                        client,
+                        executor,
+                        limiter,
+                        "get_query_results",
+                        {"queryId": query_id},
+                    )
+                    status = response.get("status")
+            finally:
+                if status not in INSIGHTS_DONE:
+                    try:
+                        client.stop_query(queryId=query_id)
+                    except Exception:
+                        pass
+        if status != "Complete":
+            sys.stderr.write(
+                "Query over "
+                + ", ".join(groups)
+                + " ended with status "
+                + str(status)
+                + "\n"
+            )
+        for row in response.get("results", []):
+            self._write(self._format_row(row))
+        if self.output != OUTPUT_TEXT:
+            sys.stdout.flush()
+
+    def _format_row(self, row):
+        fields = [
+            (column["field"], column.get("value", ""))
+            for column in row
+            if column["field"] != "@ptr"
+        ]
+        if self.output == OUTPUT_JSONL:
+            return json.dumps(dict(fields))
+        if self.output == OUTPUT_TSV:
+            return "\t".join(value.translate(TSV_ESCAPES) for _, value in fields)
+        if self.output == OUTPUT_RAW:
+            message = dict(fields).get("@message")
+            if message is not None:
+                return message[:-1] if message.endswith("\n") else message
+            return " ".join(value for _, value in fields)
+        colors = {"@timestamp": "yellow", "@log": "green", "@logStream": "cyan"}
+        return " ".join(
+            self._colored(value, colors[field]) if field in colors else value
+            for field, value in fields
+        )
 
-    def run(self):
-        self.tick()
+    async def _export_shard(self, source, client, executor, limiter):
+        """Fetch a time shard of a group into a compressed file of its own and
+        record it in the manifest when complete"""
+        path = self._manifest.shard_path(source)
+        source.sink = gzip.open(
+            path + ".tmp", "wt", encoding="utf-8", compresslevel=COMPRESSION_LEVEL
+        )
+        try:
+            done = await self._fetch_group(source, client, executor, limiter)
+        finally:
+            source.sink.close()
+        if done:
+            os.rename(path + ".tmp", path)
+            self._manifest.add_shard(source)
+        else:
+            os.remove(path + ".tmp")
 
+    def _concatenate(self, groups):
+        """Join the shards of each completely exported group in time order to
+        one file. Concatenated gzip members are a valid gzip file"""
+        failed = 0
+        for group_name in groups:
+            if self._manifest.exported(group_name):
+                continue
+            shards = self._manifest.shard_paths(group_name)
+            if len(shards) < self._manifest.shard_count:
+                failed += self._manifest.shard_count - len(shards)
+                continue
+            path = self._manifest.group_path(group_name)
+            with open(path + ".tmp", "wb") as group_file:
+                for shard in shards:
+                    with open(shard, "rb") as shard_file:
+                        shutil.copyfileobj(shard_file, group_file)
+            os.rename(path + ".tmp", path)
+            self._manifest.add_group(group_name)
+            for shard in shards:
+                os.remove(shard)
+        if failed:
+            sys.stderr.write(
+                str(failed) + " shards failed to export, run again to resume\n"
+            )
 
-class LogWorkerThread(Thread):
-    def __init__(self):
-        Thread.__init__(self)
-        self._stopped = Event()
-        self.setDaemon(True)
+    def _output(self, event, source):
+        """Format an event and print it or, when ordering, add it to the
+        buffer of its source"""
+        if self.output == OUTPUT_JSONL:
+            self._emit(
+                source,
+                event["timestamp"],
+                json.dumps(
+                    {
+                        "timestamp": event["timestamp"],
+                        "logGroupName": event["logGroupName"],
+                        "logStreamName": event["logStreamName"],
+                        "message": event["message"],
+                    }
+                ),
+            )
+            return
+        if self.output == OUTPUT_TSV:
+            self._emit(
+                source,
+                event["timestamp"],
+                "\t".join(
+                    [
+                        millis2utciso(event["timestamp"]) + "Z",
+                        event["logGroupName"],
+                        event["logStreamName"],
+                        event["message"].translate(TSV_ESCAPES),
+                    ]
+                ),
+            )
+            return
+        if self.output == OUTPUT_RAW:
+            message = event["message"]
+            if message.endswith("\n"):
+                message = message[:-1]
+            self._emit(source, event["timestamp"], message)
+            return
+        if not self._first_timestamp:
+            self._first_timestamp = event.get("timestamp", None)
+        line = []
+        group = event["logGroupName"]
+        stream = event["logStreamName"]
+        if self.short_format:
+            line.append(
+                self._colored(
+                    short_timeformat(self._first_timestamp, event["timestamp"]),
+                    "yellow",
+                )
+            )
+            if not group in self.group_mappings:
+                self.group_mappings[group] = hashed_word(group)
+                self._emit(
+                    source,
+                    event["timestamp"] - 10,
+                    " ".join(
+                        [
+                            "Mapping ",
+                            self._colored(group, "green"),
+                            "to",
+                            self._colored(self.group_mappings[group], "green"),
+                        ]
+                    ),
+                )
+            if not stream in self.stream_mappings:
+                self.stream_mappings[stream] = hashed_word(stream)
+                self._emit(
+                    source,
+                    event["timestamp"] - 10,
+                    " ".join(
+                        [
+                            "Mapping ",
+                            self._colored(stream, "cyan"),
+                            "to",
+                            self._colored(self.stream_mappings[stream], "cyan"),
+                        ]
+                    ),
+                )
+            line.append(self._colored(self.group_mappings[group], "green"))
+            line.append(self._colored(self.stream_mappings[stream], "cyan"))
+            line.append(self._stripper.strip(event["message"], event["timestamp"]))
+        else:
+            line.append(self._colored(millis2iso(event["timestamp"]), "yellow"))
+            line.append(self._colored(group, "green"))
+            line.append(self._colored(stream, "cyan"))
+            line.append(event["message"])
+        self._emit(source, event["timestamp"], " ".join(line))
+
+    def _colored(self, text, color):
+        return colored(text, color) if self.color else text
+
+    def _write(self, line):
+        if self.output == OUTPUT_TEXT:
+            uprint(line)
+        else:
+            sys.stdout.write(line + "\n")
 
-    def list_logs(self):
-        return
+    def _emit(self, source, timestamp, line):
+        if source.sink:
+            source.sink.write(line + "\n")
+            source.events += 1
+            return
+        if not self.sort:
+            self._write(line)
+            return
+        if not source.rows:
+            heapq.heappush(self._heads, (timestamp, next(self._counter), source))
+        source.rows.append((timestamp, line))
+        self._buffered += 1
+
+    def _watermark(self):
+        if not self._discovered:
+            # Groups still to be found may have earlier events
+            return self.start_time - 1
+        if not self._sources:
+            return float("inf")
+        return min(source.watermark for source in self._sources)
+
+    def _merge(self):
+        """Print buffered lines in timestamp order up to the lowest watermark
+        of all sources. This is a k-way merge over the source buffers with a
+        heap of their first lines"""
+        watermark = self._watermark()
+        heads = self._heads
+        while heads and heads[0][0] <= watermark:
+            _, _, source = heapq.heappop(heads)
+            _, line = source.rows.popleft()
+            self._buffered -= 1
+            self._write(line)
+            if source.rows:
+                heapq.heappush(heads, (source.rows[0][0], next(self._counter), source))
+
+
+class LogGroupCache(object):
+    """Log group names listed per region, profile and name prefix, kept on
+    disk for ttl seconds"""
+
+    def __init__(self, directory=LOG_GROUP_CACHE_DIR, ttl=LOG_GROUP_CACHE_TTL):
+        self.directory = directory
+        self.ttl = ttl
+
+    def _path(self, prefix):
+        key = "\0".join([region(), os.environ.get("AWS_PROFILE", ""), prefix or ""])
+        return os.path.join(
+            self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest()[:16] + ".json"
+        )
 
-    def stop(self):
-        self._stopped.set()
+    def load(self, prefix):
+        """Returns the cached group names or None if there is no fresh
+        listing"""
+        try:
+            with open(self._path(prefix)) as cache_file:
+                data = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return None
+        if time.time() - data.get("time", 0) > self.ttl:
+            return None
+        return data.get("groups")
+
+    def save(self, prefix, group_names):
+        path = self._path(prefix)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w") as cache_file:
+                json.dump({"time": time.time(), "groups": group_names}, cache_file)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            pass
 
-    def run(self):
-        self.list_logs()
 
+def literal_prefix(pattern):
+    """The literal text every match of an anchored regular expression
+    starts with or an empty string"""
+    if not pattern.startswith("^") or "|" in pattern:
+        return ""
+    prefix = []
+    index = 1
+    while index < len(pattern):
+        char = pattern[index]
+        if char == "\\":
+            if index + 1 >= len(pattern) or pattern[index + 1].isalnum():
+                break
+            char = pattern[index + 1]
+            index += 2
+        elif char in REGEX_SPECIAL:
+            break
+        else:
+            index += 1
+        if index < len(pattern) and pattern[index] in "*?{":
+            # The character may be left out
+            break
+        prefix.append(char)
+    return "".join(prefix)
+
+
+class MergeSource(object):
+    """Lines fetched from one group or time slice of a group waiting to be
+    merged. watermark is the timestamp up to which the source has
+    delivered all of its events"""
+
+    def __init__(self, group_name, start, end, index=0):
+        self.group_name = group_name
+        self.start = start
+        self.end = end
+        self.index = index
+        self.rows = deque()
+        self.watermark = start - 1
+        self.sink = None
+        self.events = 0
+
+    def advance(self, watermark):
+        self.watermark = max(self.watermark, watermark)
+
+
+class ExportManifest(object):
+    """The shards and groups an export has completed, kept in the export
+    directory so that an interrupted export of the same query resumes. The
+    time range of a resumed export is the one it was started with, unless an
+    absolute range different from it is given"""
 
-class CloudWatchLogsWorker(LogWorkerThread):
     def __init__(
-        self, work_queue, semaphore, output_queue, counter, short_format=False
+        self,
+        directory,
+        start,
+        end,
+        log_group_filter,
+        log_filter,
+        shards,
+        output,
+        absolute=False,
     ):
-        LogWorkerThread.__init__(self)
-        self.work_queue = work_queue
-        self.semaphore = semaphore
-        self.output_queue = output_queue
-        self.short_format = short_format
-        self.group_mappings = {}
-        self.stream_mappings = {}
-        self.counter = counter
-
-    @retry(tries=5, delay=2, backoff=2)
-    def filter_log_events(self, item):
-        return logs().filter_log_events(**item)
-
-    def list_logs(self):
-        do_wait = object()
+        self.directory = directory
+        self.path = os.path.join(directory, EXPORT_MANIFEST)
+        self.suffix = EXPORT_SUFFIXES[output]
+        query = {
+            "groups": log_group_filter,
+            "filter": log_filter or "",
+            "shards": shards,
+            "output": output,
+        }
+        self.data = None
+        try:
+            with open(self.path) as manifest_file:
+                self.data = json.load(manifest_file)
+        except (IOError, OSError, ValueError):
+            pass
+        if (
+            self.data
+            and self.data.get("query") == query
+            and absolute
+            and (self.data["start"], self.data["end"]) != (start, end)
+        ):
+            sys.stderr.write(
+                "Export in "
+                + directory
+                + " was started for another time range, starting over\n"
+            )
+            self.data = None
+        if not self.data or self.data.get("query") != query:
+            self.data = {
+                "query": query,
+                "start": start,
+                "end": end,
+                "shards": {},
+                "groups": {},
+            }
+        self.start = self.data["start"]
+        self.end = self.data["end"]
+        self.shard_count = self.data.get("shard_count", shards)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.save()
+
+    def _file_name(self, group_name):
+        return re.sub(r"[^\w.-]+", "_", group_name).strip("_") or "_"
+
+    def group_path(self, group_name):
+        return os.path.join(self.directory, self._file_name(group_name) + self.suffix)
+
+    def shard_path(self, source):
+        return os.path.join(
+            self.directory,
+            self._file_name(source.group_name)
+            + ".{:04d}".format(source.index)
+            + self.suffix,
+        )
 
-        def generator():
-            work_item = None
-            last_timestamp = None
-            first_timestamp = None
-            while True:
-                if not work_item:
-                    work_item = self.work_queue.get()
-                    last_timestamp = None
-                self.semaphore.acquire()
-                response = self.filter_log_events(work_item["item"])
-                for event in response.get("events", []):
-                    event["logGroupName"] = work_item["item"]["logGroupName"]
-                    last_timestamp = event.get("timestamp", None)
-                    if not first_timestamp:
-                        first_timestamp = event.get("timestamp", None)
-                    if first_timestamp:
-                        event["FirstTimestamp"] = first_timestamp
-                    yield event
+    def shard_paths(self, group_name):
+        shards = self.data["shards"].get(group_name, {})
+        return [
+            os.path.join(self.directory, shards[index]["file"])
+            for index in sorted(shards, key=int)
+        ]
+
+    def exported(self, group_name):
+        return group_name in self.data["groups"]
+
+    def shard_done(self, source):
+        return str(source.index) in self.data["shards"].get(source.group_name, {})
+
+    def add_shard(self, source):
+        self.data["shards"].setdefault(source.group_name, {})[str(source.index)] = {
+            "file": os.path.basename(self.shard_path(source)),
+            "start": source.start,
+            "end": source.end,
+            "events": source.events,
+        }
+        self.save()
+
+    def set_shard_count(self, count):
+        """Record the number of shards each group is split into, fewer than
+        requested for short time ranges"""
+        self.shard_count = self.data["shard_count"] = count
+        self.save()
+
+    def add_group(self, group_name):
+        shards = self.data["shards"].pop(group_name, {})
+        self.data["groups"][group_name] = {
+            "file": os.path.basename(self.group_path(group_name)),
+            "events": sum(shard["events"] for shard in shards.values()),
+        }
+        self.save()
+
+    def save(self):
+        with open(self.path + ".tmp", "w") as manifest_file:
+            json.dump(self.data, manifest_file, indent=2, sort_keys=True)
+        os.rename(self.path + ".tmp", self.path)
+
+
+def _throttled(err):
+    return (
+        isinstance(err, ClientError)
+        and err.response.get("Error", {}).get("Code") in THROTTLING_ERRORS
+    )
 
-                if "nextToken" in response:
-                    work_item["item"]["nextToken"] = response["nextToken"]
-                else:
-                    if "nextToken" in work_item["item"]:
-                        work_item["item"].pop("nextToken")
-                    if last_timestamp:
-                        work_item["item"]["startTime"] = last_timestamp + 1
-                    work_item["meta"]["initialQueriesDone"].set()
-                    self.work_queue.put(work_item)
-                    work_item = None
-                    yield do_wait
-
-        for event in generator():
-            if event is do_wait and not self._stopped.wait(0.0):
-                continue
-            elif self._stopped.is_set():
-                return
 
-            output = []
-            group = event["logGroupName"]
-            stream = event["logStreamName"]
-            if self.short_format:
-                output.append(
-                    colored(
-                        short_timeformat(
-                            event.get("FirstTimestamp", None), event["timestamp"]
-                        ),
-                        "yellow",
-                    )
-                )
-                if not group in self.group_mappings:
-                    self.group_mappings[group] = hashed_word(group)
-                    self.output_queue.put(
-                        (
-                            event["timestamp"] - 10,
-                            self.counter.inc(),
-                            [
-                                "Mapping ",
-                                colored(group, "green"),
-                                "to",
-                                colored(self.group_mappings[group], "green"),
-                            ],
-                        )
-                    )
-                if not stream in self.stream_mappings:
-                    self.stream_mappings[stream] = hashed_word(stream)
-                    self.output_queue.put(
-                        (
-                            event["timestamp"] - 10,
-                            self.counter.inc(),
-                            [
-                                "Mapping ",
-                                colored(stream, "cyan"),
-                                "to",
-                                colored(self.stream_mappings[stream], "cyan"),
-                            ],
-                        )
-                    )
-                output.append(colored(self.group_mappings[group], "green"))
-                output.append(colored(self.stream_mappings[stream], "cyan"))
-                message = event["message"]
-                for redundant in redundant_timeformats(event["timestamp"]):
-                    message = message.replace(redundant, "")
-                output.append(message)
-            else:
-                output.append(colored(millis2iso(event["timestamp"]), "yellow"))
-                output.append(colored(group, "green"))
-                output.append(colored(stream, "cyan"))
-                output.append(event["message"])
-            self.output_queue.put(
-                (event["timestamp"], self.counter.inc(), output)
-            )  # sort by timestamp (first value in tuple)
+def call_client(client, operation, args):
+    return getattr(client, operation)(**args)
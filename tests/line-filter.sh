@@ -0,0 +1,83 @@
+#!/bin/bash -ex
+
+# Pass a mix of access log lines, mostly health checks, through a LineFilter
+# that excludes, samples and redacts them. Checks what is kept and reports
+# throughput with the patterns combined into one alternation and searched
+# one at a time, next to a stage that passes lines on unchanged.
+python - <<'PYEOF'
+import time
+from ec2_utils.logs import LineFilter, LogStage
+
+LINES = 200000
+
+
+class Sink(object):
+    """Last stage that only keeps the lines"""
+
+    def __init__(self):
+        self.lines = []
+
+    def send(self, line, timestamp=None):
+        self.lines.append(line)
+
+
+def access_lines(count):
+    lines = []
+    for index in range(count):
+        kind = index % 10
+        if kind < 7:
+            path = "/health"
+        elif kind == 7:
+            path = "/ping"
+        elif kind == 8:
+            path = "/login?user=someone&password=hunter" + str(index)
+        else:
+            path = "/orders/" + str(index)
+        lines.append(
+            '10.0.0.1 - - [01/Jan/2026:00:00:00 +0000] "GET '
+            + path
+            + ' HTTP/1.1" 200 512 "-" "agent/1.0"'
+        )
+    return lines
+
+
+def run(stage, sink, lines):
+    start = time.time()
+    for line in lines:
+        stage.send(line)
+    elapsed = time.time() - start
+    return elapsed, len(sink.lines)
+
+
+lines = access_lines(LINES)
+options = {
+    "excludes": [r'"GET /ping ', r'"HEAD '],
+    "samples": [(0.01, r'"GET /health ')],
+    "redact": [r"password=[^&\s\"]+", r"AKIA[0-9A-Z]{16}"],
+}
+
+sink = Sink()
+elapsed, kept = run(LogStage(sink), sink, lines)
+print("Pass through: %.0f lines/s" % (LINES / elapsed))
+
+for name, extra in (
+    ("Combined", []),
+    # A backreference keeps the patterns from being combined
+    ("One at a time", [r"(x)\1{64}"]),
+):
+    sink = Sink()
+    line_filter = LineFilter(
+        sink,
+        excludes=options["excludes"] + extra,
+        samples=options["samples"],
+        redact=options["redact"],
+    )
+    assert (line_filter.exclude_pattern.combined is None) == bool(extra)
+    elapsed, kept = run(line_filter, sink, lines)
+    print("%s: %.0f lines/s, kept %d of %d" % (name, LINES / elapsed, kept, LINES))
+    assert line_filter.filtered == LINES // 10
+    assert line_filter.sampled_out == LINES * 7 // 10 - LINES * 7 // 1000
+    assert line_filter.redacted == LINES // 10
+    assert kept == LINES // 5 + LINES * 7 // 1000
+    assert not any("hunter" in line for line in sink.lines)
+PYEOF
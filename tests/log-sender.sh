@@ -0,0 +1,110 @@
+#!/bin/bash -ex
+
+# Queue lines in a LogSender that puts them to a local stand-in for
+# CloudWatch Logs with a fixed round trip time. Checks that a slow put
+# finishing after the next one does not make the sender spin and reports
+# throughput and latency from send to put.
+python - <<'PYEOF'
+import threading
+import time
+from ec2_utils.logs import FlushScheduler, LogSender
+
+ROUND_TRIP = 0.03
+
+
+class StandIn(object):
+    """Accepts PutLogEvents after ROUND_TRIP seconds, the first one after
+    slow seconds"""
+
+    def __init__(self, slow=0):
+        self.slow = slow
+        self.latencies = []
+        self.events = 0
+        self.lock = threading.Lock()
+
+    def put_log_events(self, **kwargs):
+        with self.lock:
+            delay, self.slow = self.slow or ROUND_TRIP, 0
+        time.sleep(delay)
+        now = time.time()
+        with self.lock:
+            for event in kwargs["logEvents"]:
+                if event["message"].startswith("sent "):
+                    self.latencies.append(now - float(event["message"].split()[1]))
+            self.events += len(kwargs["logEvents"])
+        return {}
+
+    def create_log_group(self, **kwargs):
+        pass
+
+    def create_log_stream(self, **kwargs):
+        pass
+
+    def stats(self):
+        return {}
+
+
+def sender(transport, **kwargs):
+    scheduler = FlushScheduler()
+    log_sender = LogSender(
+        "stand-in",
+        group="stand-in",
+        stream="stand-in",
+        scheduler=scheduler,
+        transport=transport,
+        **kwargs
+    )
+    scheduler.add_sender(log_sender)
+    scheduler.start()
+    return log_sender
+
+
+# Out of order completion: the first put takes 1.5 s, the next ones finish
+# before it
+transport = StandIn()
+log_sender = sender(transport, batch_events=10)
+transport.slow = 1.5
+calls = [0]
+do_send = log_sender._do_send
+
+
+def counted():
+    calls[0] += 1
+    do_send()
+
+
+log_sender._do_send = counted
+start = time.time()
+lines = 0
+while time.time() - start < 2:
+    log_sender.send("line " + str(lines))
+    lines += 1
+    time.sleep(0.002)
+assert log_sender.flush()
+print("Out of order completion: " + str(calls[0]) + " flushes for " + str(lines) + " lines")
+assert calls[0] < 1000
+assert transport.events == lines + 1
+
+# Throughput and latency
+transport = StandIn()
+log_sender = sender(transport)
+lines = 200000
+start = time.time()
+for line in range(lines):
+    log_sender.send("sent %.6f %d" % (time.time(), line))
+assert log_sender.flush()
+elapsed = time.time() - start
+latencies = sorted(transport.latencies)
+print(
+    "%d lines in %.2f s, %.0f lines/s, latency p50 %.0f ms p99 %.0f ms, %d puts"
+    % (
+        lines,
+        elapsed,
+        lines / elapsed,
+        latencies[len(latencies) // 2] * 1000,
+        latencies[len(latencies) * 99 // 100] * 1000,
+        log_sender.puts,
+    )
+)
+assert transport.events == lines + 1
+PYEOF
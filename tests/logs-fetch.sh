@@ -0,0 +1,150 @@
+#!/bin/bash -ex
+
+# Fetch a bounded query over many log groups from a local stand-in for
+# CloudWatch Logs with a fixed round trip time. Checks that every event is
+# printed, in order when sorting, reports the wall time against fetching the
+# pages one after the other and checks that Ctrl-C stops a tailing query.
+python - <<'PYEOF'
+import os
+import signal
+import sys
+import threading
+import time
+from ec2_utils import logs
+
+ROUND_TRIP = 0.05
+GROUPS = 200
+GROUP_EVENTS = 500
+PAGE_EVENTS = 100
+START = 1767225600000
+END = START + 3600 * 1000
+
+
+class StandIn(object):
+    """Lists GROUPS groups and returns GROUP_EVENTS events per group spread
+    over START to END, PAGE_EVENTS at a time after ROUND_TRIP seconds"""
+
+    def __init__(self, groups=GROUPS):
+        self.groups = ["stand-in-%03d" % index for index in range(groups)]
+        self.pages = 0
+        self.lock = threading.Lock()
+
+    def client(self, *args, **kwargs):
+        return self
+
+    def describe_log_groups(self, **kwargs):
+        start = int(kwargs.get("nextToken", 0))
+        end = start + kwargs["limit"]
+        resp = {
+            "logGroups": [
+                {"logGroupName": group_name} for group_name in self.groups[start:end]
+            ]
+        }
+        if end < len(self.groups):
+            resp["nextToken"] = str(end)
+        return resp
+
+    def filter_log_events(self, **kwargs):
+        time.sleep(ROUND_TRIP)
+        with self.lock:
+            self.pages += 1
+        step = (END - START) // GROUP_EVENTS
+        timestamps = [
+            timestamp
+            for timestamp in range(START, END, step)
+            if kwargs["startTime"] <= timestamp <= kwargs.get("endTime", END)
+        ]
+        first = int(kwargs.get("nextToken", 0))
+        last = first + PAGE_EVENTS
+        resp = {
+            "events": [
+                {
+                    "timestamp": timestamp,
+                    "logStreamName": "stream",
+                    "message": kwargs["logGroupName"] + " " + str(timestamp),
+                }
+                for timestamp in timestamps[first:last]
+            ]
+        }
+        if last < len(timestamps):
+            resp["nextToken"] = str(last)
+        return resp
+
+
+class Lines(object):
+    """Stands in for stdout and keeps the printed lines"""
+
+    def __init__(self):
+        self.lines = []
+
+    def write(self, data):
+        self.lines.extend(data.splitlines())
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def fetch(stand_in, **kwargs):
+    logs.Session = lambda: stand_in
+    logs.logs = lambda: stand_in
+    logs.region = lambda: "stand-in"
+    groups = logs.CloudWatchLogsGroups(
+        log_group_filter="stand-in",
+        output=logs.OUTPUT_TSV,
+        rate=1000,
+        burst=1000,
+        max_rate=1000,
+        **kwargs
+    )
+    stdout, sys.stdout = sys.stdout, Lines()
+    start = time.time()
+    try:
+        groups.get_logs()
+    finally:
+        lines, sys.stdout = sys.stdout.lines, stdout
+    return time.time() - start, lines
+
+
+def report(name, stand_in, elapsed, lines):
+    print(
+        "%s: %d events from %d pages in %.2f s, %.0f times faster than one "
+        "page at a time"
+        % (
+            name,
+            len(lines),
+            stand_in.pages,
+            elapsed,
+            stand_in.pages * ROUND_TRIP / elapsed,
+        )
+    )
+
+
+start_time = str(START // 1000)
+end_time = str(END // 1000)
+
+# Many groups, one task per group
+stand_in = StandIn()
+elapsed, lines = fetch(stand_in, start_time=start_time, end_time=end_time)
+report("Unordered", stand_in, elapsed, lines)
+assert len(lines) == GROUPS * GROUP_EVENTS
+assert len(set(lines)) == len(lines)
+
+# Ordered over few groups, each split in time slices that the merge puts
+# back in order
+stand_in = StandIn(groups=2)
+elapsed, lines = fetch(stand_in, start_time=start_time, end_time=end_time, sort=True)
+report("Ordered", stand_in, elapsed, lines)
+assert len(lines) == 2 * GROUP_EVENTS
+timestamps = [int(line.split()[-1]) for line in lines]
+assert timestamps == sorted(timestamps)
+
+# Ctrl-C while tailing
+stand_in = StandIn()
+threading.Timer(2, os.kill, (os.getpid(), signal.SIGINT)).start()
+elapsed, lines = fetch(stand_in, start_time=start_time)
+print("Tailing stopped %.2f s after Ctrl-C" % (elapsed - 2))
+assert elapsed < 4
+PYEOF
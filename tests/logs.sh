@@ -11,3 +11,5 @@ kill $PID
 ec2 logs ec2-test-group -s "5 minutes ago" -e now | grep 'kill $PID'
 ec2 logs ec2-test-group -t -s "5 minutes ago" -e now | grep 'kill $PID'
 
+ec2 logs ec2-test-group -s "5 minutes ago" -e now --output tsv | cut -f1 | sort -c
+ec2 logs ec2-test-group -s "5 minutes ago" -e now --output tsv --order | cut -f1 | sort -c
@@ -0,0 +1,41 @@
+#!/bin/bash -ex
+
+# Stress test following a file that is rotated by rename and by copytruncate
+# while lines are being written to it. Every written line must be seen
+# exactly once.
+LINES=${ROTATE_TEST_LINES:-50000}
+ROTATE_EVERY=${ROTATE_TEST_EVERY:-5000}
+for MODE in rename copytruncate; do
+  DIR=$(mktemp -d)
+  LOG=$DIR/rotate.log
+  touch $LOG
+  ec2 pytail $LOG > $DIR/out.txt &
+  PID=$!
+  sleep 2
+  START=$(date +%s%N)
+  python -c "
+import os, shutil, sys
+log, lines, every, mode = sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), sys.argv[4]
+for first in range(1, lines + 1, every):
+    data = ''.join('line %d\\n' % i for i in range(first, min(first + every, lines + 1)))
+    if mode == 'copytruncate' and first > 1:
+        shutil.copyfile(log, log + '.' + str(first - 1))
+        # Truncate and write the next lines in one go without pausing, so the
+        # file often grows past the old offset or is copied again before the
+        # follower wakes up
+        with open(log, 'w') as out:
+            out.write(data)
+    else:
+        if mode == 'rename' and first > 1:
+            os.rename(log, log + '.' + str(first - 1))
+        with open(log, 'a') as out:
+            out.write(data)
+" $LOG $LINES $ROTATE_EVERY $MODE
+  END=$(date +%s%N)
+  sleep 5
+  kill $PID
+  echo "Wrote $LINES lines with $MODE every $ROTATE_EVERY in $(( (END - START) / 1000000 )) ms"
+  [ "$(wc -l < $DIR/out.txt)" -eq "$LINES" ]
+  [ "$(sort -u $DIR/out.txt | wc -l)" -eq "$LINES" ]
+  rm -rf $DIR
+done